@@ -3,170 +3,36 @@
 import os, json, html, time, streamlit as st
 from personas import get_persona
 from llm_router import call_with_fallback
+from output_guard import generate_guarded, rules_for_persona
+from llm_scheduler import PRIORITY_TEST
+from lyra_core import drop_message, get_session_id, rerun_fragment
+from cancellation import cancel_session, finish_turn, new_turn_token
+from blob_store import get_blob_store, export_log, import_log
+from components.search_panel import SearchPanel
+from session_manager import get_session_manager
+from token_predictor import get_token_predictor
+from conversation_engine import LLMConversation
+from opening_pool import get_opening_pool
+import profiler
 
 
 # ================== 定数（人格から取得） ==================
 # persona = get_dpersona()
 persona = get_persona( "floria_ja" )
-SYSTEM_PROMPT = persona.system_prompt
 STARTER_HINT = persona.starter_hint
 PARTNER_NAME = persona.name
+OUTPUT_RULES = rules_for_persona(persona)
 
 MAX_LOG = 500
 DISPLAY_LIMIT = 20000  # 20K文字の表示上限（保存はフル）
+UPLOAD_CACHE_KEY = "_upload_parsed"  # 解析済みのアップロード（file_id, messages, エラー）
 
-# ================== ページ設定 ==================
-st.set_page_config(page_title="Lyra Engine Prototype", layout="wide")
-st.markdown("""
-<style>
-.block-container { max-width: 1100px; padding-left: 2rem; padding-right: 2rem; }
-.chat-bubble { white-space: pre-wrap; overflow-wrap:anywhere; word-break:break-word;
-  line-height:1.7; padding:.8rem 1rem; border-radius:.7rem; margin:.35rem 0; }
-.chat-bubble.user { background:#f4f6fb; }
-.chat-bubble.assistant { background:#eaf7ff; }
-</style>
-""", unsafe_allow_html=True)
-
-# ================== session_state 初期化 ==================
-if "user_input" not in st.session_state:
-    st.session_state["user_input"] = ""
-if "show_hint" not in st.session_state:
-    st.session_state["show_hint"] = False
-
-DEFAULTS = {
-    "_busy": False,
-    "_do_send": False,
-    "_pending_text": "",
-    "_clear_input": False,
-    "_do_reset": False,
-    "_ask_reset": False,
-}
-for k, v in DEFAULTS.items():
-    if k not in st.session_state:
-        st.session_state[k] = v
-
-# --- フラグ処理 ---
-if st.session_state.get("_clear_input"):
-    st.session_state["_clear_input"] = False
-    st.session_state["user_input"] = ""
-
-if st.session_state.get("_do_reset"):
-    st.session_state["_do_reset"] = False
-    st.session_state.update({
-        "user_input": "",
-        "_pending_text": "",
-        "_busy": False,
-        "_do_send": False,
-        "_ask_reset": False,
-        "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
-    })
-
-# ================== 会話状態 ==================
-if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
-
-# ================== シークレット ==================
-OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", ""))
-OPENROUTER_API_KEY = st.secrets.get("OPENROUTER_API_KEY", os.getenv("OPENROUTER_API_KEY", ""))
-
-if not OPENAI_API_KEY:
-    st.error("OPENAI_API_KEY が未設定です。Streamlit → Settings → Secrets で設定してください。")
-    st.stop()
-
-# llm_router が os.getenv で読むので環境変数に流す
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-if OPENROUTER_API_KEY:
-    os.environ["OPENROUTER_API_KEY"] = OPENROUTER_API_KEY
-
-# ================== パラメータUI ==================
-st.title("❄️ Lyra Engine Prototype")
-with st.expander("世界観とあなたの役割（ロール）", expanded=False):
-    # エンジンとしては中立の説明にする（具体的なキャラ名は persona 側の責務）
-    st.markdown(
-        """**概要**：この画面は「人格（ペルソナ）×対話エンジン」の挙動を確認するためのプロトタイプです。  
-現在はデフォルトのペルソナと対話していますが、将来的には複数人格を切り替えて利用できます。  
-
-**あなた**：物語世界の登場人物として、相手に語りかけ・問いかけ・提案を行う当事者です。  
-**お願い**：命令口調よりも、状況描写や気持ち・意図を添えて話しかけると、対話が豊かになります。"""
-    )
-    st.checkbox("入力ヒントを表示する", key="show_hint")
-
-with st.expander("接続設定", expanded=False):
-    c1, c2, c3 = st.columns(3)
-    temperature = c1.slider("temperature", 0.0, 1.5, 0.70, 0.05)
-    max_tokens  = c2.slider("max_tokens（1レス上限）", 64, 4096, 800, 16)
-    wrap_width  = c3.slider("折り返し幅", 20, 100, 80, 1)
-
-    r1, r2 = st.columns(2)
-    # いまはフォールバック先の LLM 内部で完結した1レス生成なので、「未使用」と明記
-    auto_continue = r1.checkbox("長文を自動で継ぎ足す（未使用）", True)
-    max_cont      = r2.slider("最大継ぎ足し回数（未使用）", 1, 6, 3)
-
-st.markdown(
-    f"<style>.chat-bubble {{ max-width: min(90vw, {wrap_width}ch); }}</style>",
-    unsafe_allow_html=True
-)
-
-# ================== 接続テスト ==================
-with st.expander("接続テスト（任意）", expanded=False):
-    if st.button("モデルへテストリクエスト"):
-        test_msgs = [
-            {"role": "system", "content": "ping"},
-            {"role": "user", "content": "pong?"},
-        ]
-        try:
-            with st.spinner("テスト中…"):
-                reply, meta = call_with_fallback(
-                    test_msgs,
-                    temperature=0.0,
-                    max_tokens=16,
-                )
-            st.code(json.dumps(meta, ensure_ascii=False, indent=2), language="json")
-            st.success(f"返信: {reply}")
-        except Exception as e:
-            st.error(f"接続エラー: {e}")
-
-# ================== 送信関数（エンジン本体） ==================
-def engine_say(user_text: str):
-    """現在のペルソナと会話するためのコア関数。LLMの詳細は llm_router 側に隠蔽。"""
-    # ログ丸め
-    if len(st.session_state["messages"]) > MAX_LOG:
-        base_sys = st.session_state["messages"][0]
-        st.session_state["messages"] = [base_sys] + st.session_state["messages"][-(MAX_LOG - 1):]
-
-    # ユーザー発言を履歴に追加
-    st.session_state["messages"].append({"role": "user", "content": user_text})
-
-    # 送るコンテキスト（system + 直近）
-    base = st.session_state["messages"]
-    max_slice = 60
-    convo = [base[0]] + base[-max_slice:]
-
-    with st.spinner(f"{PARTNER_NAME}が考えています…"):
-        reply, meta = call_with_fallback(
-            convo,
-            temperature=float(temperature),
-            max_tokens=int(max_tokens),
-        )
-
-    # デバッグ表示用
-    st.session_state["_last_call_meta"] = meta
-
-    if not reply.strip():
-        reply = "（返答の生成に失敗しました…）"
-
-    st.session_state["messages"].append({"role": "assistant", "content": reply})
 
-# ================== 会話表示 ==================
-st.subheader("会話")
-dialog = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")]
-
-for m in dialog:
-    role = m["role"]
+def render_bubble(m: dict) -> None:
     raw = m["content"].strip()
     shown = raw if len(raw) <= DISPLAY_LIMIT else (raw[:DISPLAY_LIMIT] + " …[truncated]")
     txt = html.escape(shown)
-    if role == "user":
+    if m["role"] == "user":
         st.markdown(
             f"<div class='chat-bubble user'><b>あなた：</b><br>{txt}</div>",
             unsafe_allow_html=True,
@@ -177,130 +43,435 @@ for m in dialog:
             unsafe_allow_html=True,
         )
 
-# ================== デバッグ情報 ==================
-show_dbg = st.checkbox("デバッグを表示", False)
-if show_dbg and "_last_call_meta" in st.session_state:
-    st.markdown("###### 最後の呼び出し情報")
-    st.json(st.session_state["_last_call_meta"])
-
-# ================== 入力欄 ==================
-hint_col, _ = st.columns([1, 3])
-if hint_col.button("ヒントを入力欄に挿入", disabled=st.session_state["_busy"]):
-    st.session_state["user_input"] = STARTER_HINT
-
-st.text_area(
-    "あなたの言葉（複数行OK・空行不要）",
-    key="user_input",
-    height=160,
-    placeholder=(STARTER_HINT if st.session_state.get("show_hint") else ""),
-)
-
-# ================== ボタン群 ==================
-c_send, c_new, c_show, c_dl = st.columns([1, 1, 1, 1])
-
-if c_send.button(
-    "送信",
-    type="primary",
-    disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
-):
-    txt = st.session_state.get("user_input", "").strip()
-    if txt:
-        st.session_state["_pending_text"] = txt
-        st.session_state["_do_send"] = True
-        st.session_state["_clear_input"] = True
-        st.rerun()
-
-if st.session_state["_do_send"] and not st.session_state["_busy"]:
-    st.session_state["_do_send"] = False
-    st.session_state["_busy"] = True
-    try:
-        txt = st.session_state.get("_pending_text", "")
-        st.session_state["_pending_text"] = ""
-        if txt:
-            engine_say(txt)
-    finally:
-        st.session_state["_busy"] = False
-        st.rerun()
-
-# ================== 新しい会話 ==================
-if st.session_state.get("_ask_reset", False):
-    with st.container():
-        st.warning("会話履歴がすべて消えます。続行しますか？")
-        cc1, cc2 = st.columns(2)
-        confirm = cc1.button("はい、リセットする", use_container_width=True)
-        cancel = cc2.button("やめる", use_container_width=True)
-        if confirm:
-            st.session_state["_do_reset"] = True
-            st.session_state["_ask_reset"] = False
+
+def system_prompt() -> str:
+    """
+    人格本文。プロセス内で 1 つの文字列を共有する（保存ログからは参照だけにする）。
+    会話を作る・読み込むときに初めて登録するので、import 時には何もしない。
+    """
+    return get_blob_store().register(persona.system_prompt)
+
+
+def opening_conversation() -> LLMConversation:
+    """新しい会話の最初の挨拶用（lyra_engine と同じプロンプトなので作り置きプールも共有）。"""
+    return LLMConversation(
+        system_prompt=persona.system_prompt,
+        style_hint=persona.style_hint,
+        output_rules=OUTPUT_RULES,
+        persona_key=persona.char_id,
+    )
+
+
+def new_messages() -> list:
+    """新しい会話の初期状態。作り置きの挨拶があれば、それを最初の発言にする。"""
+    messages = [{"role": "system", "content": system_prompt()}]
+    opening = get_opening_pool().take(opening_conversation())
+    if opening is not None:
+        messages.append({"role": "assistant", "content": opening[0]})
+    return messages
+
+
+def main() -> None:
+    # ================== ページ設定 ==================
+    st.set_page_config(page_title="Lyra Engine Prototype", layout="wide")
+    st.markdown("""
+    <style>
+    .block-container { max-width: 1100px; padding-left: 2rem; padding-right: 2rem; }
+    .chat-bubble { white-space: pre-wrap; overflow-wrap:anywhere; word-break:break-word;
+      line-height:1.7; padding:.8rem 1rem; border-radius:.7rem; margin:.35rem 0; }
+    .chat-bubble.user { background:#f4f6fb; }
+    .chat-bubble.assistant { background:#eaf7ff; }
+    </style>
+    """, unsafe_allow_html=True)
+
+    # ================== session_state 初期化 ==================
+    # 退避済みなら会話を戻す（ほかのアイドルセッションの退避もここで行う）
+    get_session_manager().touch(st.session_state)
+
+    if "user_input" not in st.session_state:
+        st.session_state["user_input"] = ""
+    if "show_hint" not in st.session_state:
+        st.session_state["show_hint"] = False
+
+    DEFAULTS = {
+        "_busy": False,
+        "_do_send": False,
+        "_pending_text": "",
+        "_clear_input": False,
+        "_do_reset": False,
+        "_ask_reset": False,
+    }
+    for k, v in DEFAULTS.items():
+        if k not in st.session_state:
+            st.session_state[k] = v
+
+    if st.session_state.get("_do_reset"):
+        st.session_state["_do_reset"] = False
+        # 走り残っている生成があれば、古い会話に返答が入る前に止める
+        cancel_session(get_session_id(st.session_state), "reset")
+        st.session_state.update({
+            "user_input": "",
+            "_pending_text": "",
+            "_busy": False,
+            "_do_send": False,
+            "_ask_reset": False,
+            "messages": new_messages(),
+        })
+
+    # ================== 会話状態 ==================
+    if "messages" not in st.session_state:
+        st.session_state["messages"] = new_messages()
+
+    # ================== シークレット ==================
+    OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", ""))
+    OPENROUTER_API_KEY = st.secrets.get("OPENROUTER_API_KEY", os.getenv("OPENROUTER_API_KEY", ""))
+
+    if not OPENAI_API_KEY:
+        st.error("OPENAI_API_KEY が未設定です。Streamlit → Settings → Secrets で設定してください。")
+        st.stop()
+
+    # llm_router が os.getenv で読むので環境変数に流す
+    os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
+    if OPENROUTER_API_KEY:
+        os.environ["OPENROUTER_API_KEY"] = OPENROUTER_API_KEY
+
+    # ================== パラメータUI ==================
+    st.title("❄️ Lyra Engine Prototype")
+    with st.expander("世界観とあなたの役割（ロール）", expanded=False):
+        # エンジンとしては中立の説明にする（具体的なキャラ名は persona 側の責務）
+        st.markdown(
+            """**概要**：この画面は「人格（ペルソナ）×対話エンジン」の挙動を確認するためのプロトタイプです。  
+現在はデフォルトのペルソナと対話していますが、将来的には複数人格を切り替えて利用できます。  
+
+**あなた**：物語世界の登場人物として、相手に語りかけ・問いかけ・提案を行う当事者です。  
+**お願い**：命令口調よりも、状況描写や気持ち・意図を添えて話しかけると、対話が豊かになります。"""
+        )
+        st.checkbox("入力ヒントを表示する", key="show_hint")
+
+    with st.expander("接続設定", expanded=False):
+        c1, c2, c3 = st.columns(3)
+        temperature = c1.slider("temperature", 0.0, 1.5, 0.70, 0.05)
+        max_tokens  = c2.slider("max_tokens（1レス上限）", 64, 4096, 800, 16)
+        wrap_width  = c3.slider("折り返し幅", 20, 100, 80, 1)
+
+        r1, r2 = st.columns(2)
+        # いまはフォールバック先の LLM 内部で完結した1レス生成なので、「未使用」と明記
+        auto_continue = r1.checkbox("長文を自動で継ぎ足す（未使用）", True)
+        max_cont      = r2.slider("最大継ぎ足し回数（未使用）", 1, 6, 3)
+
+    st.markdown(
+        f"<style>.chat-bubble {{ max-width: min(90vw, {wrap_width}ch); }}</style>",
+        unsafe_allow_html=True
+    )
+
+    # ================== 接続テスト ==================
+    with st.expander("接続テスト（任意）", expanded=False):
+        if st.button("モデルへテストリクエスト"):
+            test_msgs = [
+                {"role": "system", "content": "ping"},
+                {"role": "user", "content": "pong?"},
+            ]
+            try:
+                with st.spinner("テスト中…"):
+                    reply, meta = call_with_fallback(
+                        test_msgs,
+                        temperature=0.0,
+                        max_tokens=16,
+                        session_id=get_session_id(st.session_state),
+                        priority=PRIORITY_TEST,
+                    )
+                st.code(json.dumps(meta, ensure_ascii=False, indent=2), language="json")
+                st.success(f"返信: {reply}")
+            except Exception as e:
+                st.error(f"接続エラー: {e}")
+
+    # ================== 送信関数（エンジン本体） ==================
+    def engine_say(user_text: str):
+        """現在のペルソナと会話するためのコア関数。LLMの詳細は llm_router 側に隠蔽。"""
+        # ログ丸め
+        if len(st.session_state["messages"]) > MAX_LOG:
+            base_sys = st.session_state["messages"][0]
+            st.session_state["messages"] = [base_sys] + st.session_state["messages"][-(MAX_LOG - 1):]
+            # 描画済みの位置がずれるので、ターン後はページ全体を描き直す
+            st.session_state["_log_rewritten"] = True
+
+        # ユーザー発言を履歴に追加
+        user_message = {"role": "user", "content": user_text}
+        st.session_state["messages"].append(user_message)
+
+        # 送るコンテキスト（system + 直近）
+        base = st.session_state["messages"]
+        max_slice = 60
+        convo = [base[0]] + base[-max_slice:]
+
+        # 生成途中の本文をその場で表示（出力ガードで修復済みのもの）
+        live = st.empty()
+
+        def show_partial(text: str) -> None:
+            live.markdown(
+                f"<div class='chat-bubble assistant'><b>{PARTNER_NAME}：</b><br>{html.escape(text)}</div>",
+                unsafe_allow_html=True,
+            )
+
+        session_id = get_session_id(st.session_state)
+        # スライダー値は上限。実際の max_tokens はこれまでの応答長から決める
+        predictor = get_token_predictor()
+        limit, prediction = predictor.predict(persona.char_id, session_id, int(max_tokens))
+        token = new_turn_token(session_id)
+        try:
+            with st.spinner(f"{PARTNER_NAME}が考えています…"), profiler.span("generate_guarded"):
+                reply, meta = generate_guarded(
+                    convo,
+                    temperature=float(temperature),
+                    max_tokens=limit,
+                    rules=OUTPUT_RULES,
+                    on_delta=show_partial,
+                    session_id=session_id,
+                    cancel_token=token,
+                )
+        except BaseException:
+            # リセット・タブを閉じるなどでスクリプトが止められたら、生成も止める
+            token.cancel("interrupted")
+            raise
+        finally:
+            finish_turn(session_id, token)
+
+        predictor.observe(persona.char_id, session_id, meta)
+        meta = dict(meta, max_tokens=prediction)
+
+        # デバッグ表示用
+        st.session_state["_last_call_meta"] = meta
+        if meta.get("cancelled"):
+            # 返事のない発言を残すと、次のターンで user が 2 つ続いてしまう
+            drop_message(base, user_message)
+            return
+
+        if not reply.strip():
+            reply = "（返答の生成に失敗しました…）"
+
+        st.session_state["messages"].append({"role": "assistant", "content": reply})
+
+    # ================== 会話表示 ==================
+    # ここまで（と下の各パネル）はページ全体の rerun でだけ描く。
+    # 入力・送信・ストリーミングは chat_turn() フラグメントの中だけで rerun する。
+    st.subheader("会話")
+    dialog = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")]
+
+    with profiler.span("chat_log"):
+        for m in dialog:
+            render_bubble(m)
+    # フラグメント側は、これより後ろに増えた分だけを描く
+    st.session_state["_log_rendered_upto"] = len(st.session_state["messages"])
+    st.session_state["_log_rewritten"] = False
+
+    # ================== 入力欄・最新の吹き出し ==================
+    def needs_full_rerun() -> bool:
+        # ログを丸めた・デバッグ表示中（フラグメント外の表示も新しくしたい）ならページ全体
+        return bool(st.session_state.get("_log_rewritten") or st.session_state.get("_show_dbg"))
+
+    @st.fragment
+    def chat_turn() -> None:
+        with profiler.fragment_profile("chat_turn", st.session_state):
+            # フラグメントだけの rerun でも操作中として扱う（退避されていれば戻す）
+            get_session_manager().touch(st.session_state)
+
+            # --- フラグ処理（入力欄を作る前に消す） ---
+            if st.session_state.get("_clear_input"):
+                st.session_state["_clear_input"] = False
+                st.session_state["user_input"] = ""
+
+            # 前回のページ全体の描画より後に増えた吹き出し
+            upto = st.session_state.get("_log_rendered_upto", 0)
+            for m in st.session_state["messages"][upto:]:
+                if m["role"] in ("user", "assistant"):
+                    render_bubble(m)
+
+            hint_col, _ = st.columns([1, 3])
+            if hint_col.button("ヒントを入力欄に挿入", disabled=st.session_state["_busy"]):
+                st.session_state["user_input"] = STARTER_HINT
+
+            st.text_area(
+                "あなたの言葉（複数行OK・空行不要）",
+                key="user_input",
+                height=160,
+                placeholder=(STARTER_HINT if st.session_state.get("show_hint") else ""),
+            )
+
+            if st.button(
+                "送信",
+                type="primary",
+                disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
+            ):
+                txt = st.session_state.get("user_input", "").strip()
+                if txt:
+                    st.session_state["_pending_text"] = txt
+                    st.session_state["_do_send"] = True
+                    st.session_state["_clear_input"] = True
+                    rerun_fragment()
+
+            if st.session_state["_do_send"] and not st.session_state["_busy"]:
+                st.session_state["_do_send"] = False
+                st.session_state["_busy"] = True
+                try:
+                    txt = st.session_state.get("_pending_text", "")
+                    st.session_state["_pending_text"] = ""
+                    if txt:
+                        engine_say(txt)
+                finally:
+                    st.session_state["_busy"] = False
+                    rerun_fragment(full=needs_full_rerun())
+
+    chat_turn()
+
+    # ================== デバッグ情報 ==================
+    show_dbg = st.checkbox("デバッグを表示", False, key="_show_dbg")
+    with st.sidebar:
+        st.checkbox(
+            "rerun ごとにプロファイルを取る",
+            key=profiler.STATE_KEY,
+            help=f"環境変数 {profiler.PROFILE_ENV}=1 でも常時有効になります。",
+        )
+    if show_dbg and "_last_call_meta" in st.session_state:
+        st.markdown("###### 最後の呼び出し情報")
+        st.json(st.session_state["_last_call_meta"])
+    if show_dbg:
+        stats = get_session_manager().stats()
+        st.caption(
+            f"セッション: 常駐 {stats['resident']} / 全 {stats['sessions']}"
+            f"（{stats['resident_kb']} KB）・退避 {stats['spilled']} 回 / 復元 {stats['restored']} 回"
+        )
+    if show_dbg and profiler.RESULT_KEY in st.session_state:
+        prof = st.session_state[profiler.RESULT_KEY]
+        st.markdown("###### 直近 rerun のプロファイル")
+        st.caption(profiler.caption(prof))
+        if prof["spans"]:
+            st.table(prof["spans"])
+        st.dataframe(prof["hotspots"], use_container_width=True)
+
+    # ================== ボタン群 ==================
+    c_new, c_show, _ = st.columns([1, 1, 2])
+
+    # ================== 新しい会話 ==================
+    if st.session_state.get("_ask_reset", False):
+        with st.container():
+            st.warning("会話履歴がすべて消えます。続行しますか？")
+            cc1, cc2 = st.columns(2)
+            confirm = cc1.button("はい、リセットする", use_container_width=True)
+            cancel = cc2.button("やめる", use_container_width=True)
+            if confirm:
+                st.session_state["_do_reset"] = True
+                st.session_state["_ask_reset"] = False
+                st.rerun()
+            elif cancel:
+                st.session_state["_ask_reset"] = False
+    else:
+        if c_new.button(
+            "新しい会話（履歴が消えます）",
+            use_container_width=True,
+            disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
+        ):
+            st.session_state["_ask_reset"] = True
             st.rerun()
-        elif cancel:
-            st.session_state["_ask_reset"] = False
-else:
-    if c_new.button(
-        "新しい会話（履歴が消えます）",
+
+    # ================== 最近10件 ==================
+    if c_show.button(
+        "最近10件を表示",
         use_container_width=True,
         disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
     ):
-        st.session_state["_ask_reset"] = True
-        st.rerun()
-
-# ================== 最近10件 ==================
-if c_show.button(
-    "最近10件を表示",
-    use_container_width=True,
-    disabled=(st.session_state["_busy"] or st.session_state["_ask_reset"]),
-):
-    st.info("最近10件の会話を下に表示します。")
-    recent = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")][-10:]
-    for m in recent:
-        role_label = "あなた" if m["role"] == "user" else PARTNER_NAME
-        st.write(f"**{role_label}**：{m['content'].strip()}")
-
-# ================== 保存・読込 ==================
-st.markdown("---")
-st.subheader("会話ログの保存")
-st.download_button(
-    "JSON をダウンロード",
-    json.dumps(st.session_state["messages"], ensure_ascii=False, indent=2),
-    file_name="lyra_chat_log.json",
-    mime="application/json",
-    use_container_width=True,
-)
-
-st.subheader("会話ログの読み込み")
-up = st.file_uploader("保存した JSON を選択", type=["json"])
-col_l, col_m, col_r = st.columns(3)
-load_mode = col_l.radio("読込モード", ["置き換え", "末尾に追記"], horizontal=True)
-show_preview = col_m.checkbox("内容をプレビュー", value=True)
-do_load = col_r.button(
-    "読み込む",
-    use_container_width=True,
-    disabled=(up is None or st.session_state.get("_busy", False) or st.session_state["_ask_reset"]),
-)
-
-if up is not None:
+        st.info("最近10件の会話を下に表示します。")
+        recent = [m for m in st.session_state["messages"] if m["role"] in ("user", "assistant")][-10:]
+        for m in recent:
+            role_label = "あなた" if m["role"] == "user" else PARTNER_NAME
+            st.write(f"**{role_label}**：{m['content'].strip()}")
+
+    # ================== ログ検索 ==================
+    with st.expander("会話ログ検索", expanded=False), profiler.span("search_panel"):
+        SearchPanel().render(PARTNER_NAME)
+
+    # ================== 保存・読込 ==================
+    st.markdown("---")
+    st.subheader("会話ログの保存")
+    # 送信はフラグメント内の rerun で済ませるので、ここは古い描画のまま残ることがある。
+    # JSON は毎回作らず、クリックされた時点の会話から作る（別スレッドで呼ばれる）。
+    # 持ち帰ったログは別の環境でも読めるよう、人格本文も同梱する。
+    # 押されるまでセッションに残る関数なので、会話のリストそのものは抱えず ID だけ持つ
+    # （アイドル退避で外した会話がここから生き残らないように。退避中はスナップショットから読む）
+    session_id = get_session_id(st.session_state)
+
+    def export_json() -> str:
+        with profiler.span("export_json"):
+            messages = get_session_manager().messages(session_id) or []
+            return json.dumps(export_log(messages, embed=True), ensure_ascii=False, indent=2)
+
+    st.download_button(
+        "JSON をダウンロード",
+        export_json,
+        file_name="lyra_chat_log.json",
+        mime="application/json",
+        on_click="ignore",
+        use_container_width=True,
+    )
+
+    log_loader()
+
+    # 描画を終えてから、次に来る新しいセッションのための挨拶を補充する
+    get_opening_pool().warm(opening_conversation())
+
+
+@st.fragment
+def log_loader() -> None:
+    """会話ログの読み込み。ファイル選択やプレビュー操作ではここだけを rerun する。"""
+    get_session_manager().touch(st.session_state)
+    st.subheader("会話ログの読み込み")
+    up = st.file_uploader("保存した JSON を選択", type=["json"])
+    col_l, col_m, col_r = st.columns(3)
+    load_mode = col_l.radio("読込モード", ["置き換え", "末尾に追記"], horizontal=True)
+    show_preview = col_m.checkbox("内容をプレビュー", value=True)
+    do_load = col_r.button(
+        "読み込む",
+        use_container_width=True,
+        disabled=(up is None or st.session_state.get("_busy", False) or st.session_state["_ask_reset"]),
+    )
+
+    if up is None:
+        st.session_state.pop(UPLOAD_CACHE_KEY, None)
+        return
+
     try:
-        imported = json.load(up)
-        ok = isinstance(imported, list) and all(
-            isinstance(x, dict) and "role" in x and "content" in x for x in imported
-        )
-        if not ok:
-            st.error("JSON 形式が不正です。messages の配列（各要素に role と content）が必要です。")
+        # 同じファイルは rerun のたびに解析し直さない
+        cached = st.session_state.get(UPLOAD_CACHE_KEY)
+        if cached and cached[0] == up.file_id:
+            imported, error = cached[1], cached[2]
         else:
+            with profiler.span("upload_parse"):
+                raw_log = json.load(up)
+            try:
+                # 旧形式（配列）と新形式（blobs 参照）の両方を受け付け、system 本文は共有化
+                # （参照先が引けない system は、現在の人格本文で補う）
+                imported, error = import_log(raw_log, fallback_system=system_prompt()), None
+            except ValueError as e:
+                imported, error = None, str(e)
+            st.session_state[UPLOAD_CACHE_KEY] = (up.file_id, imported, error)
+
+        if error is not None:
+            st.error(f"JSON 形式が不正です。{error}")
+        if imported is not None:
             if show_preview:
                 st.caption("先頭5件プレビュー")
                 st.json(imported[:5])
             if do_load:
-                # system が先頭にないログには、現在の SYSTEM_PROMPT を補う
+                cancel_session(get_session_id(st.session_state), "load")
+                # system が先頭にないログには、現在の人格本文を補う
                 if not (len(imported) > 0 and imported[0].get("role") == "system"):
-                    imported = [{"role": "system", "content": SYSTEM_PROMPT}] + imported
+                    imported = [{"role": "system", "content": system_prompt()}] + imported
 
                 if load_mode == "置き換え":
-                    st.session_state["messages"] = imported
+                    st.session_state["messages"] = list(imported)
                 else:
                     base = st.session_state.get(
                         "messages",
-                        [{"role": "system", "content": SYSTEM_PROMPT}],
+                        [{"role": "system", "content": system_prompt()}],
                     )
                     tail = (
                         imported[1:]
@@ -317,8 +488,15 @@ if up is not None:
                     "_do_reset": False,
                 })
                 st.session_state.pop("_last_call_meta", None)
+                st.session_state.pop(UPLOAD_CACHE_KEY, None)
 
                 st.success("読込が完了しました。")
                 st.rerun()
     except Exception as e:
         st.error(f"JSON の読み込みに失敗しました：{e}")
+
+
+# ================== エントリーポイント ==================
+# rerun 全体をオプトインのプロファイラで包む（無効時は何もしない）
+with profiler.rerun_profile("app", st.session_state):
+    main()
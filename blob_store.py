@@ -0,0 +1,210 @@
+# blob_store.py — メッセージ本文のコンテンツアドレス型ストア
+#
+# system プロンプトやペルソナ本文のように、どのセッションでも同じ長文を
+# ハッシュ（sha256）をキーに 1 回だけ保持する。
+# - プロセス内：register() したもの（ペルソナ由来のプロンプト）だけを持ち、
+#               intern() で同一内容の文字列オブジェクトを共有する。
+#               アップロードされたログの system 本文などは登録しない（際限なく増えるため）
+# - ディスク  ：ログから参照されたときに BLOB_DIR/<先頭2文字>/<hash>.txt へ 1 回だけ書く
+# - ログ形式  ：messages は content_ref で参照し、ストアで引けない本文だけ blobs に載せる
+#               （プレイヤーが持ち帰るログは embed=True で本文も同梱する。退避のスナップショットは参照だけ）
+
+import hashlib
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+
+BLOB_DIR = os.getenv("LYRA_BLOB_DIR", "blobs")
+LOG_FORMAT = "lyra-log/2"
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BlobStore:
+    """hash → 本文 のストア。root が None ならメモリのみ。"""
+
+    def __init__(self, root: Optional[str] = BLOB_DIR) -> None:
+        self.root = root
+        self._blobs: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    # ===== 登録・取得 =====
+    def register(self, text: str) -> str:
+        """
+        ペルソナ由来の本文を共有対象として登録し、共有オブジェクトを返す。
+        メモリに置くだけで、ディスクにはログから参照されたときに書く。
+        """
+        key = content_hash(text)
+        blob = self._blobs.get(key)
+        if blob is not None:
+            return blob
+        with self._lock:
+            return self._blobs.setdefault(key, text)
+
+    def intern(self, text: str) -> str:
+        """登録済みと同じ内容なら共有オブジェクトを、そうでなければ text をそのまま返す。"""
+        return self._blobs.get(content_hash(text), text)
+
+    def persist(self, key: str) -> bool:
+        """
+        key の本文を後から get() できるようにする（登録済みならディスクへ書く）。
+        引けるようになれば True。
+        """
+        blob = self._blobs.get(key)
+        if blob is not None:
+            return self._write(key, blob) or not self.root
+        return key in self
+
+    def get(self, key: str) -> str:
+        blob = self._blobs.get(key)
+        if blob is not None:
+            return blob
+
+        path = self._path(key)
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                blob = f.read()
+            with self._lock:
+                return self._blobs.setdefault(key, blob)
+
+        raise KeyError(f"blob が見つかりません: {key}")
+
+    def __contains__(self, key: str) -> bool:
+        if key in self._blobs:
+            return True
+        path = self._path(key)
+        return bool(path and os.path.exists(path))
+
+    # ===== 内部 =====
+    def _path(self, key: str) -> Optional[str]:
+        if not self.root:
+            return None
+        return os.path.join(self.root, key[:2], f"{key}.txt")
+
+    def _write(self, key: str, text: str) -> bool:
+        path = self._path(key)
+        if not path:
+            return False
+        if os.path.exists(path):
+            return True
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+            return True
+        except OSError:
+            # ディスクに書けなくてもメモリ上の共有は効く（ログには本文を同梱する）
+            return False
+
+
+_default_store: Optional[BlobStore] = None
+_default_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    """プロセス共有のストア。"""
+    global _default_store
+    if _default_store is None:
+        with _default_lock:
+            if _default_store is None:
+                _default_store = BlobStore()
+    return _default_store
+
+
+# ====== messages との相互変換 ======
+def _is_shared(m: Dict[str, Any]) -> bool:
+    # セッションをまたいで同一になりやすいのは system（ペルソナ本文）
+    return m.get("role") == "system" and isinstance(m.get("content"), str)
+
+
+def intern_messages(
+    messages: List[Dict[str, Any]],
+    store: Optional[BlobStore] = None,
+) -> List[Dict[str, Any]]:
+    """system 本文を共有オブジェクトに差し替えた messages を返す。"""
+    store = store or get_blob_store()
+    out = []
+    for m in messages:
+        if _is_shared(m):
+            m = dict(m, content=store.intern(m["content"]))
+        out.append(m)
+    return out
+
+
+def export_log(
+    messages: List[Dict[str, Any]],
+    store: Optional[BlobStore] = None,
+    embed: bool = False,
+) -> Dict[str, Any]:
+    """
+    保存用のログ形式に変換する。
+    system 本文は content_ref で参照し、ストアで引ける本文（ペルソナ由来）は載せない。
+    引けないもの、または embed=True（ダウンロードなど別の環境へ持ち出すとき）なら
+    blobs に 1 回だけ同梱する。参照だけのログは、同じストアで読み戻すとき専用。
+    """
+    store = store or get_blob_store()
+    blobs: Dict[str, str] = {}
+    packed = []
+    for m in messages:
+        if _is_shared(m):
+            key = content_hash(m["content"])
+            if embed or not store.persist(key):
+                blobs.setdefault(key, m["content"])
+            ref = {k: v for k, v in m.items() if k != "content"}
+            ref["content_ref"] = key
+            packed.append(ref)
+        else:
+            packed.append(m)
+    return {"format": LOG_FORMAT, "blobs": blobs, "messages": packed}
+
+
+def import_log(
+    data: Any,
+    store: Optional[BlobStore] = None,
+    fallback_system: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    保存ログを messages に戻す。旧形式（messages の配列そのもの）も受け付ける。
+    同梱の本文は、登録済みと同じものだけ共有オブジェクトに差し替える（ストアには足さない）。
+    system の参照先が引けないとき（blobs/ が消えた・人格本文が変わった）は
+    fallback_system（現在の人格本文など）で補う。
+    形式が不正、または補えない参照先の本文が見つからなければ ValueError。
+    """
+    store = store or get_blob_store()
+
+    if isinstance(data, list):
+        packed, blobs = data, {}
+    elif isinstance(data, dict) and data.get("format") == LOG_FORMAT:
+        packed, blobs = data.get("messages"), data.get("blobs") or {}
+    else:
+        raise ValueError("ログ形式が不正です。")
+
+    if not isinstance(packed, list):
+        raise ValueError("ログ形式が不正です。")
+
+    out: List[Dict[str, Any]] = []
+    for m in packed:
+        if not (isinstance(m, dict) and "role" in m and ("content" in m or "content_ref" in m)):
+            raise ValueError("messages の各要素に role と content が必要です。")
+
+        if "content_ref" in m:
+            key = m["content_ref"]
+            if key in blobs:
+                text = store.intern(blobs[key])
+            else:
+                try:
+                    text = store.get(key)
+                except KeyError:
+                    if m.get("role") != "system" or fallback_system is None:
+                        raise ValueError(f"参照先の本文が見つかりません: {key}")
+                    text = fallback_system
+            m = {k: v for k, v in m.items() if k != "content_ref"}
+            m["content"] = text
+        out.append(m)
+
+    return intern_messages(out, store)
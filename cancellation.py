@@ -0,0 +1,102 @@
+# cancellation.py — 生成中のターンを途中で打ち切るためのキャンセルトークン
+#
+# LyraCore.proceed_turn → LLMConversation → output_guard → llm_router と
+# 同じトークンを渡していき、cancel() されたら
+# - スケジューラで順番待ち中なら列から抜ける
+# - ストリーミング中なら HTTP 接続をその場で閉じる
+# セッションごとに「今走っているターン」のトークンを登録しておき、
+# 新しい会話・ログ読込・再送信・切断のときに cancel_session() で止める。
+
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+class Cancelled(Exception):
+    """キャンセル済みのトークンで処理を始めようとした。"""
+
+
+class CancelToken:
+    def __init__(self) -> None:
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception:
+                # 接続のクローズ失敗などは、止めたい側には関係ないので無視
+                pass
+
+    def on_cancel(self, cb: Callable[[], None]) -> Callable[[], None]:
+        """
+        キャンセル時に呼ぶ関数を登録し、登録解除用の関数を返す。
+        既にキャンセル済みなら即座に呼ぶ。
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return lambda: self._remove(cb)
+        cb()
+        return lambda: None
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise Cancelled(self.reason or "cancelled")
+
+    def _remove(self, cb: Callable[[], None]) -> None:
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+
+# ====== セッションごとの実行中ターン ======
+_turns: Dict[str, CancelToken] = {}
+_turns_lock = threading.Lock()
+
+
+def new_turn_token(session_id: str) -> CancelToken:
+    """
+    このセッションの新しいターン用トークンを発行する。
+    前のターンがまだ走っていれば、それは "superseded" で打ち切る。
+    """
+    token = CancelToken()
+    with _turns_lock:
+        prev = _turns.get(session_id)
+        _turns[session_id] = token
+    if prev is not None:
+        prev.cancel("superseded")
+    return token
+
+
+def finish_turn(session_id: str, token: CancelToken) -> None:
+    with _turns_lock:
+        if _turns.get(session_id) is token:
+            del _turns[session_id]
+
+
+def cancel_session(session_id: str, reason: str = "cancelled") -> bool:
+    """セッションで走っているターンがあれば打ち切る。打ち切ったら True。"""
+    with _turns_lock:
+        token = _turns.pop(session_id, None)
+    if token is None:
+        return False
+    token.cancel(reason)
+    return True
+
+
+def is_turn_running(session_id: str) -> bool:
+    with _turns_lock:
+        return session_id in _turns
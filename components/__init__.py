@@ -2,6 +2,7 @@ from .preflight import PreflightChecker
 from .debug_panel import DebugPanel
 from .chat_log import ChatLog
 from .player_input import PlayerInput
+from .search_panel import SearchPanel
 
-# __all__ = ["PreflightChecker", "DebugPanel", "ChatLog", "PlayerInput" ]
-__all__ = ["PreflightChecker", "DebugPanel", "ChatLog", "PlayerInput" ]
+# __all__ = ["PreflightChecker", "DebugPanel", "ChatLog", "PlayerInput", "SearchPanel" ]
+__all__ = ["PreflightChecker", "DebugPanel", "ChatLog", "PlayerInput", "SearchPanel" ]
@@ -13,7 +13,10 @@ class ChatLog:
 
     def render(self, messages: List[Dict[str, str]]) -> None:
         st.subheader("💬 会話ログ")
+        self.render_bubbles(messages)
 
+    def render_bubbles(self, messages: List[Dict[str, str]]) -> None:
+        """見出しなしで吹き出しだけを描く（フラグメント内の最新分の描画にも使う）。"""
         dialog = [m for m in messages if m["role"] in ("user", "assistant")]
 
         for m in dialog:
@@ -32,7 +35,9 @@ class ChatLog:
                     unsafe_allow_html=True,
                 )
             else:
+                # シーンモードでは発言者がメッセージごとに付く
+                speaker = html.escape(m.get("speaker") or self.partner_name)
                 st.markdown(
-                    f"<div class='chat-bubble assistant'><b>{self.partner_name}：</b><br>{txt}</div>",
+                    f"<div class='chat-bubble assistant'><b>{speaker}：</b><br>{txt}</div>",
                     unsafe_allow_html=True,
                 )
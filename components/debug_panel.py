@@ -2,6 +2,10 @@
 from typing import Any, Dict, Optional
 import streamlit as st
 
+import profiler
+from debug_buffer import get_prompt_buffer
+from session_manager import get_session_manager
+
 
 class DebugPanel:
     """LLM 呼び出しメタ情報を出すだけの簡易デバッグパネル"""
@@ -24,11 +28,63 @@ class DebugPanel:
             self._meta = meta
 
         show = st.checkbox(self.checkbox_label, False, key="debug_panel_show")
+        # トグルは毎 rerun 描画しておかないと値が消えるので、show より前に置く
+        st.checkbox(
+            "rerun ごとにプロファイルを取る",
+            key=profiler.STATE_KEY,
+            help=f"環境変数 {profiler.PROFILE_ENV}=1 でも常時有効になります。",
+        )
         if not show:
             return
 
         st.markdown("###### 最後の LLM 呼び出し情報")
         if self._meta:
             st.json(self._meta)
+            self.render_prompt()
         else:
             st.info("まだ LLM 呼び出し情報はありません。")
+
+        self.render_profile()
+        self.render_sessions()
+
+    def render_prompt(self) -> None:
+        """
+        プロンプト全文は meta に持たないので、チェックされたときだけ
+        セッションのリングバッファから引いて表示する。
+        """
+        key = (self._meta or {}).get("prompt_hash")
+        if not key:
+            return
+        if not st.checkbox("プロンプト全文を表示", False, key="debug_panel_prompt"):
+            return
+
+        messages = get_prompt_buffer(st.session_state).get(key)
+        if messages is None:
+            st.info("このプロンプトはバッファから追い出されています。")
+            return
+        for m in messages:
+            st.markdown(f"**[{m['role']}]**")
+            st.text(m["content"])
+
+    def render_profile(self) -> None:
+        """直近 rerun / ターンのプロファイル結果（ホットスポット上位）を表示。"""
+        for key, label in (
+            (profiler.RESULT_KEY, "直近の rerun"),
+            (profiler.TURN_RESULT_KEY, "直近のターン"),
+        ):
+            summary = st.session_state.get(key)
+            if not summary:
+                continue
+            st.markdown(f"###### プロファイル（{label}）")
+            st.caption(profiler.caption(summary))
+            if summary["spans"]:
+                st.table(summary["spans"])
+            st.dataframe(summary["hotspots"], use_container_width=True)
+
+    def render_sessions(self) -> None:
+        """プロセス内のセッション数と常駐メモリ量（概算）。"""
+        stats = get_session_manager().stats()
+        st.caption(
+            f"セッション: 常駐 {stats['resident']} / 全 {stats['sessions']}"
+            f"（{stats['resident_kb']} KB）・退避 {stats['spilled']} 回 / 復元 {stats['restored']} 回"
+        )
@@ -0,0 +1,86 @@
+# components/search_panel.py
+import html
+import json
+import time
+from typing import Optional
+
+import streamlit as st
+
+from blob_store import import_log
+from log_search import SESSION_INDEX_KEY, LogSearchIndex, get_session_index
+from lyra_core import get_session_id
+from session_manager import get_session_manager
+
+
+class SearchPanel:
+    """会話ログ全文検索の入力欄と結果表示（検索できるのは自分の会話と、自分が追加したログだけ）"""
+
+    # 索引に追加済みのアップロード（rerun のたびに取り込み直さない）
+    INDEXED_KEY = "_search_indexed_files"
+    SESSION_LABEL = "この会話"
+
+    def __init__(self, index: Optional[LogSearchIndex] = None, limit: int = 20):
+        self._index = index
+        self.limit = limit
+
+    @property
+    def index(self) -> LogSearchIndex:
+        if self._index is not None:
+            return self._index
+        # セッション専用のインデックスに、いまの会話の増えた分だけを足してから使う
+        state = st.session_state
+        if SESSION_INDEX_KEY not in state:
+            # 初回、または退避でインデックスごと外された。アップロード分も取り込み直す
+            state.pop(self.INDEXED_KEY, None)
+        index = get_session_index(state)
+        index.sync_session(
+            get_session_id(state), state.get("messages", []), label=self.SESSION_LABEL
+        )
+        return index
+
+    # 検索語の入力やファイル追加では、このパネルだけを rerun する
+    @st.fragment
+    def render(self, partner_name: str = "") -> None:
+        # フラグメントだけの rerun でも実行中として扱う（退避されていれば戻す）
+        get_session_manager().touch(st.session_state)
+        st.subheader("🔎 会話ログ検索")
+        index = self.index
+
+        # 保存済みログをその場で索引に足す
+        files = st.file_uploader(
+            "保存したログを検索対象に追加",
+            type=["json"],
+            accept_multiple_files=True,
+            key="search_panel_files",
+        )
+        indexed = st.session_state.setdefault(self.INDEXED_KEY, set())
+        for f in files or []:
+            if f.file_id in indexed:
+                continue
+            try:
+                f.seek(0)
+                # system は索引に入れないので、参照先が引けなくても空で補えばよい
+                messages = import_log(json.load(f), fallback_system="")
+                n = index.index_session(f"upload:{f.name}", messages, label=f.name)
+                indexed.add(f.file_id)
+                st.caption(f"{f.name}: {n} 件を索引に追加しました。")
+            except ValueError as e:
+                st.error(f"{f.name} を読み込めませんでした：{e}")
+
+        query = st.text_input("検索語（例：湖のほとり）", key="search_panel_query")
+        if not query.strip():
+            stats = index.stats()
+            st.caption(f"{stats['sessions']} セッション / {stats['messages']} 件を検索できます。")
+            return
+
+        t0 = time.perf_counter()
+        hits = index.search(query, self.limit)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        st.caption(f"{len(hits)} 件（{elapsed_ms:.1f} ms）")
+
+        for h in hits:
+            who = "あなた" if h.role == "user" else (partner_name or "相手")
+            st.markdown(
+                f"**{html.escape(h.label)}** #{h.index}（{who}）<br>{html.escape(h.snippet)}",
+                unsafe_allow_html=True,
+            )
@@ -1,8 +1,13 @@
 # conversation_engine.py — LLM 呼び出しを統括する会話エンジン層
 
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from llm_router import call_with_fallback
+from blob_store import content_hash, get_blob_store
+from cancellation import CancelToken
+from debug_buffer import PromptRingBuffer, prompt_hash
+from llm_scheduler import PRIORITY_INTERACTIVE
+from output_guard import OutputRules, generate_guarded
+from token_predictor import get_token_predictor
 
 
 class LLMConversation:
@@ -19,11 +24,16 @@ class LLMConversation:
         temperature: float = 0.7,
         max_tokens: int = 800,
         style_hint: str = "",
+        output_rules: Optional[OutputRules] = None,
+        persona_key: str = "",
     ) -> None:
         self.system_prompt = system_prompt
         self.temperature = float(temperature)
         self.max_tokens = int(max_tokens)
         self.style_hint = style_hint.strip() if style_hint else ""
+        self.output_rules = output_rules or OutputRules()
+        # 応答長の学習単位（未指定なら system プロンプトで見分ける）
+        self.persona_key = persona_key or content_hash(system_prompt)[:12]
 
         # デフォルトのスタイル指針（persona に style_hint がない場合のみ使用）
         self.default_style_hint = (
@@ -44,6 +54,8 @@ class LLMConversation:
         system_content = self.system_prompt
         effective_style_hint = self.style_hint or self.default_style_hint
         system_content += "\n\n" + effective_style_hint
+        # 毎ターン同じ長文になるので、全セッションで 1 つの文字列を共有する
+        system_content = get_blob_store().register(system_content)
 
         messages: List[Dict[str, str]] = [
             {"role": "system", "content": system_content}
@@ -74,24 +86,49 @@ class LLMConversation:
     def generate_reply(
         self,
         history: List[Dict[str, str]],
+        prompt_buffer: Optional[PromptRingBuffer] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        session_id: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        cancel_token: Optional[CancelToken] = None,
+        learn: bool = True,
     ) -> Tuple[str, Dict[str, Any]]:
         """
         会話履歴を受け取り、LLM応答テキストとメタ情報を返す。
+        meta にはプロンプトのハッシュと大きさだけを載せる。
+        全文は prompt_buffer が渡されたときだけそこへ預ける。
+        応答はストリーミングで受けながら出力ガードを通す（on_delta で途中経過）。
+        session_id / priority はスケジューラでの順番待ちに使う。
+        cancel_token が取り消されると、生成途中でも接続を閉じて打ち切る。
+        max_tokens は self.max_tokens を上限に、これまでの応答長から毎ターン決める。
+        learn=False なら、この応答の長さは以降の推定に使わない（作り置きの挨拶など）。
         """
         messages = self.build_messages(history)
+        predictor = get_token_predictor()
+        max_tokens, prediction = predictor.predict(self.persona_key, session_id, self.max_tokens)
 
-        text, meta = call_with_fallback(
-            messages=messages,
+        text, meta = generate_guarded(
+            messages,
             temperature=self.temperature,
-            max_tokens=self.max_tokens,
+            max_tokens=max_tokens,
+            rules=self.output_rules,
+            on_delta=on_delta,
+            session_id=session_id,
+            priority=priority,
+            cancel_token=cancel_token,
         )
 
-        # DebugPanel用の情報を追記
+        if learn:
+            predictor.observe(self.persona_key, session_id, meta)
+
+        # DebugPanel用の情報を追記（全文はコピーせず参照だけ）
+        key = prompt_hash(messages)
         meta = dict(meta)
-        meta["prompt_messages"] = messages
-        meta["prompt_preview"] = "\n\n".join(
-            f"[{m['role']}] {m['content'][:300]}"
-            for m in messages
-        )
+        meta["max_tokens"] = prediction
+        meta["prompt_hash"] = key
+        meta["prompt_messages_count"] = len(messages)
+        meta["prompt_chars"] = sum(len(m["content"]) for m in messages)
+        if prompt_buffer is not None:
+            prompt_buffer.put(key, messages)
 
         return text, meta
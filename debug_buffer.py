@@ -0,0 +1,59 @@
+# debug_buffer.py — デバッグ用プロンプト全文のセッション内リングバッファ
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+# session_state 上のキーと、1セッションで保持するプロンプト数の上限
+PROMPT_BUFFER_KEY = "_prompt_buffer"
+DEFAULT_CAPACITY = 8
+
+
+def prompt_hash(messages: List[Dict[str, str]]) -> str:
+    """プロンプト（messages 配列）の短いハッシュ。meta からの参照キーに使う。"""
+    raw = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptRingBuffer:
+    """
+    直近 capacity 件のプロンプト全文だけを保持する。
+    meta には prompt_hash だけを載せ、全文はデバッグパネルを開いたときに
+    ここから引く。
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity = max(1, int(capacity))
+        self._items: "OrderedDict[str, List[Dict[str, str]]]" = OrderedDict()
+        # シーンモードでは複数スレッドから put される
+        self._lock = threading.Lock()
+
+    def put(self, key: str, messages: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._items[key] = messages
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def get(self, key: Optional[str]) -> Optional[List[Dict[str, str]]]:
+        if not key:
+            return None
+        return self._items.get(key)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def get_prompt_buffer(state: Any) -> PromptRingBuffer:
+    """セッションごとのバッファを取得（なければ作る）。"""
+    buf = state.get(PROMPT_BUFFER_KEY)
+    if buf is None:
+        buf = PromptRingBuffer()
+        state[PROMPT_BUFFER_KEY] = buf
+    return buf
@@ -0,0 +1,164 @@
+# llm_cassette.py — llm_router 用の録画 / 再生（カセット）バックエンド
+#
+# LYRA_CASSETTE=path/to/file.jsonl(.gz)
+# LYRA_CASSETTE_MODE=record      : 実際に GPT を呼び、結果をカセットに追記
+#                    replay      : カセットから元の速度で再生（ネットワークなし）
+#                    replay_fast : カセットから待ち時間なしで即再生
+# 再生時に該当するリクエストがなければ CassetteMiss を投げる。
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+CASSETTE_ENV = "LYRA_CASSETTE"
+CASSETTE_MODE_ENV = "LYRA_CASSETTE_MODE"
+MODES = ("record", "replay", "replay_fast")
+
+
+class CassetteMiss(RuntimeError):
+    """再生モードで、カセットに該当するリクエストがなかった。"""
+
+
+def fingerprint(
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    stream: bool,
+) -> str:
+    raw = json.dumps(
+        {
+            "model": model,
+            "messages": messages,
+            "temperature": round(float(temperature), 4),
+            "max_tokens": int(max_tokens),
+            "stream": bool(stream),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+
+class Cassette:
+    """
+    1行1エントリの JSON Lines。
+    {"fp": ..., "chunks": [[前チャンクからの ms, テキスト], ...],
+     "usage": {...}, "finish_reason": ...}
+    同じ fingerprint が複数あれば録画順に返し、尽きたら最後のものを返し続ける。
+    """
+
+    def __init__(self, path: str, mode: str) -> None:
+        if mode not in MODES:
+            raise ValueError(f"{CASSETTE_MODE_ENV} は {MODES} のいずれかです: {mode!r}")
+        self.path = path
+        self.mode = mode
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode != "record"
+
+    @property
+    def realtime(self) -> bool:
+        return self.mode == "replay"
+
+    # ===== 再生 =====
+    def lookup(self, fp: str) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._entries.get(fp)
+            if not entries:
+                raise CassetteMiss(
+                    f"カセットに該当するリクエストがありません: fp={fp} ({self.path})。"
+                    f"{CASSETTE_MODE_ENV}=record で録り直してください。"
+                )
+            i = self._cursor.get(fp, 0)
+            self._cursor[fp] = i + 1
+            return entries[min(i, len(entries) - 1)]
+
+    def play(self, entry: Dict[str, Any]) -> Iterator[str]:
+        for dt_ms, text in entry["chunks"]:
+            if self.realtime and dt_ms:
+                time.sleep(dt_ms / 1000)
+            yield text
+
+    # ===== 録画 =====
+    def record(self, fp: str, entry: Dict[str, Any]) -> None:
+        entry = dict(entry, fp=fp)
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._entries.setdefault(fp, []).append(entry)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with self._open("at") as f:
+                f.write(line)
+
+    # ===== 内部 =====
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode, encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self) -> None:
+        with self._open("rt") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self._entries.setdefault(entry["fp"], []).append(entry)
+
+
+class ChunkRecorder:
+    """録画中のストリームで、チャンクごとの間隔を測りながら溜める。"""
+
+    def __init__(self) -> None:
+        self.chunks: List[List[Any]] = []
+        self._last = time.perf_counter()
+
+    def add(self, text: str) -> None:
+        now = time.perf_counter()
+        self.chunks.append([int((now - self._last) * 1000), text])
+        self._last = now
+
+
+_active: Optional[Cassette] = None
+_active_key: Optional[tuple] = None
+_active_lock = threading.Lock()
+
+
+def get_cassette() -> Optional[Cassette]:
+    """環境変数で指定されたカセット（未指定なら None）。"""
+    global _active, _active_key
+    path = os.getenv(CASSETTE_ENV)
+    if not path:
+        return _active if _active_key == ("manual",) else None
+
+    key = (path, os.getenv(CASSETTE_MODE_ENV, "replay"))
+    with _active_lock:
+        if _active_key != key:
+            _active = Cassette(path, key[1])
+            _active_key = key
+        return _active
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = "replay_fast") -> Iterator[Cassette]:
+    """テストやベンチから、環境変数を使わずにカセットを差し込む。"""
+    global _active, _active_key
+    prev = (_active, _active_key)
+    cassette = Cassette(path, mode)
+    _active, _active_key = cassette, ("manual",)
+    try:
+        yield cassette
+    finally:
+        _active, _active_key = prev
@@ -1,9 +1,16 @@
 # llm_router.py — GPT-4o 専用シンプルルーター
 
 import os
-from typing import Any, Dict, List, Tuple
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
 
-from openai import OpenAI
+from cancellation import CancelToken, Cancelled
+from llm_cassette import CassetteMiss, ChunkRecorder, fingerprint, get_cassette
+from llm_scheduler import PRIORITY_INTERACTIVE, Ticket, estimate_cost, get_scheduler
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 
 # ====== 環境変数 ======
@@ -24,14 +31,18 @@ def _call_gpt(
     """
     OpenAI GPT 系モデル（デフォルト gpt-4o）に対する単発呼び出し。
     Hermes / OpenRouter などは一切使わない。
+    カセットが有効なら、録画 / 再生を挟む。
     """
+    cassette = get_cassette()
+    fp = None
+    if cassette is not None:
+        fp = fingerprint(MAIN_MODEL, messages, temperature, max_tokens, stream=False)
+        if cassette.replaying:
+            entry = cassette.lookup(fp)
+            return "".join(cassette.play(entry)), entry.get("usage") or {}
 
-    # 呼び出し時点での環境変数を見る
-    api_key = os.getenv("OPENAI_API_KEY") or OPENAI_API_KEY_INITIAL
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY が設定されていません。")
-
-    client_openai = OpenAI(api_key=api_key)
+    t0 = time.perf_counter()
+    client_openai = _client()
 
     resp = client_openai.chat.completions.create(
         model=MAIN_MODEL,
@@ -41,37 +52,266 @@ def _call_gpt(
     )
 
     text = resp.choices[0].message.content or ""
+    usage = _usage_dict(getattr(resp, "usage", None))
 
-    usage: Dict[str, Any] = {}
-    if getattr(resp, "usage", None) is not None:
-        usage = {
-            "prompt_tokens": getattr(resp.usage, "prompt_tokens", None),
-            "completion_tokens": getattr(resp.usage, "completion_tokens", None),
-            "total_tokens": getattr(resp.usage, "total_tokens", None),
-        }
-
+    if cassette is not None:
+        cassette.record(fp, {
+            "chunks": [[int((time.perf_counter() - t0) * 1000), text]],
+            "usage": usage,
+            "finish_reason": resp.choices[0].finish_reason,
+        })
     return text, usage
 
 
+def _client() -> "OpenAI":
+    # 呼び出し時点での環境変数を見る
+    api_key = os.getenv("OPENAI_API_KEY") or OPENAI_API_KEY_INITIAL
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY が設定されていません。")
+    # openai の import は 0.5 秒ほどかかるので、最初の呼び出しまで遅らせる
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+
+def _acquire(
+    messages: List[Dict[str, str]],
+    max_tokens: int,
+    session_id: Optional[str],
+    priority: int,
+    cancel_token: Optional[CancelToken] = None,
+) -> Optional[Ticket]:
+    """スケジューラで順番を待つ。カセット再生中は API を叩かないので並ばない。"""
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return None
+    return get_scheduler().acquire(
+        session_id, priority, estimate_cost(messages, max_tokens), cancel_token
+    )
+
+
+def _release(ticket: Optional[Ticket], usage: Dict[str, Any]) -> None:
+    if ticket is not None:
+        get_scheduler().release(ticket, usage.get("total_tokens"))
+
+
+def _queue_meta(meta: Dict[str, Any], ticket: Optional[Ticket]) -> None:
+    if ticket is not None:
+        meta["queue_wait_ms"] = ticket.wait_ms
+        meta["queue_depth"] = ticket.queue_depth
+
+
+def _usage_dict(usage: Any) -> Dict[str, Any]:
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "total_tokens": getattr(usage, "total_tokens", None),
+    }
+
+
+# ====== GPT系（ストリーミング） ======
+class ChatStream:
+    """
+    GPT のストリーミング応答。for で回すとテキストの差分が順に出てくる。
+    途中で close() すれば HTTP 接続ごと打ち切る（残りのトークンは生成されない）。
+    回し終えた後は usage / finish_reason / meta が埋まる。
+    カセットが有効なら、チャンクとその間隔を録画 / 再生する。
+    cancel_token が取り消されると別スレッドからでも即 close() し、
+    usage が届いていなければ受け取ったチャンク数から概算して残す。
+    """
+
+    def __init__(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: Optional[str] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> None:
+        self.usage: Dict[str, Any] = {}
+        self.finish_reason: Optional[str] = None
+        self.meta: Dict[str, Any] = {"route": "gpt", "model_main": MAIN_MODEL}
+        self.cancel_token = cancel_token
+        self._done = False
+        self._finish_lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._n_chunks = 0
+        self._prompt_est = estimate_cost(messages, 0)
+        self._unhook = lambda: None
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
+        self._cassette = get_cassette()
+        self._fp: Optional[str] = None
+        self._replay: Optional[Dict[str, Any]] = None
+        self._recorder: Optional[ChunkRecorder] = None
+        self._resp = None
+        self._ticket: Optional[Ticket] = None
+        if self._cassette is not None:
+            self._fp = fingerprint(MAIN_MODEL, messages, temperature, max_tokens, stream=True)
+            self.meta["cassette"] = self._cassette.mode
+            if self._cassette.replaying:
+                self._replay = self._cassette.lookup(self._fp)
+                return
+
+        # 接続はスケジューラの許可が出てから張る（ストリームが閉じるまで枠を持つ）
+        self._ticket = _acquire(messages, max_tokens, session_id, priority, cancel_token)
+        _queue_meta(self.meta, self._ticket)
+        if self._cassette is not None:
+            # 録画のチャンク間隔は許可が出てから測る（順番待ちの時間は再生しない）
+            self._recorder = ChunkRecorder()
+        try:
+            self._resp = _client().chat.completions.create(
+                model=MAIN_MODEL,
+                messages=messages,
+                temperature=float(temperature),
+                max_tokens=int(max_tokens),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+        except BaseException:
+            _release(self._ticket, {})
+            self._ticket = None
+            raise
+
+        if cancel_token is not None:
+            self._unhook = cancel_token.on_cancel(self.close)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+    def __iter__(self) -> Iterator[str]:
+        if self._replay is not None:
+            for text in self._cassette.play(self._replay):
+                if self.cancelled:
+                    break
+                self._n_chunks += 1
+                yield text
+            else:
+                self.usage = self._replay.get("usage") or {}
+                self.finish_reason = self._replay.get("finish_reason")
+            self._finish()
+            return
+
+        try:
+            for chunk in self._resp:
+                if getattr(chunk, "usage", None) is not None:
+                    self.usage = _usage_dict(chunk.usage)
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    self.finish_reason = choice.finish_reason
+                if choice.delta and choice.delta.content:
+                    self._n_chunks += 1
+                    if self._recorder is not None:
+                        self._recorder.add(choice.delta.content)
+                    yield choice.delta.content
+        except Exception:
+            # 別スレッドからの close() で読み出しが失敗するのは想定内
+            if not self.cancelled:
+                raise
+        self._finish()
+
+    def close(self) -> None:
+        if self._done:
+            return
+        if self._resp is not None:
+            self._resp.close()
+        self._finish()
+
+    def _finish(self) -> None:
+        with self._finish_lock:
+            if self._done:
+                return
+            self._done = True
+        self._unhook()
+        if not self.usage and (self._n_chunks or self.cancelled):
+            # 打ち切ると usage は届かないので、ストリームのチャンク数（≒トークン数）で概算
+            self.usage = {
+                "prompt_tokens": self._prompt_est,
+                "completion_tokens": self._n_chunks,
+                "total_tokens": self._prompt_est + self._n_chunks,
+                "estimated": True,
+            }
+        if self.cancelled:
+            self.meta["cancelled"] = self.cancel_token.reason
+        _release(self._ticket, self.usage)
+        self._ticket = None
+        if self._recorder is not None and not self.cancelled:
+            # 出力ガードが close() で打ち切ったストリームは、打ち切りまでのチャンクを録っておく
+            # （再生側もガードが同じ位置で打ち切るので、取り直しまで再現できる）。
+            # 利用者の操作で取り消されたものは録らない（再生では完結した返答に見えてしまう）
+            self._cassette.record(self._fp, {
+                "chunks": self._recorder.chunks,
+                "usage": self.usage,
+                "finish_reason": self.finish_reason,
+            })
+        self.meta["usage_main"] = self.usage
+        self.meta["finish_reason"] = self.finish_reason
+        self.meta["latency_ms"] = round((time.perf_counter() - self._t0) * 1000, 1)
+
+
 # ====== 公開インターフェース ======
 def call_with_fallback(
     messages: List[Dict[str, str]],
     temperature: float = 0.7,
     max_tokens: int = 800,
+    session_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    cancel_token: Optional[CancelToken] = None,
 ) -> Tuple[str, Dict[str, Any]]:
     """
     以前は GPT → Hermes のフォールバックだったが、
     今は GPT-4o 単体のみを呼び出す。
+    呼び出し前にセッション横断のスケジューラで順番を待つ。
     """
     meta: Dict[str, Any] = {}
+    t0 = time.perf_counter()
 
     try:
-        text, usage = _call_gpt(messages, temperature, max_tokens)
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        ticket = _acquire(messages, max_tokens, session_id, priority, cancel_token)
+        _queue_meta(meta, ticket)
+        usage: Dict[str, Any] = {}
+        try:
+            text, usage = _call_gpt(messages, temperature, max_tokens)
+        finally:
+            _release(ticket, usage)
         meta["route"] = "gpt"
         meta["model_main"] = MAIN_MODEL
         meta["usage_main"] = usage
+        meta["latency_ms"] = round((time.perf_counter() - t0) * 1000, 1)
         return text, meta
+    except CassetteMiss:
+        # 再生モードでの取りこぼしは設定ミスなので、握りつぶさずに落とす
+        raise
+    except Cancelled as e:
+        meta["route"] = "cancelled"
+        meta["cancelled"] = str(e)
+        return "", meta
     except Exception as e:
         meta["route"] = "error"
         meta["gpt_error"] = str(e)
+        meta["latency_ms"] = round((time.perf_counter() - t0) * 1000, 1)
         return "", meta
+
+
+def stream_with_fallback(
+    messages: List[Dict[str, str]],
+    temperature: float = 0.7,
+    max_tokens: int = 800,
+    session_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    cancel_token: Optional[CancelToken] = None,
+) -> ChatStream:
+    """
+    call_with_fallback のストリーミング版。
+    接続エラーはそのまま例外で返すので、呼び出し側で meta に落とすこと。
+    取り消し済みの cancel_token なら Cancelled。
+    """
+    return ChatStream(messages, temperature, max_tokens, session_id, priority, cancel_token)
@@ -0,0 +1,204 @@
+# llm_scheduler.py — セッション横断の LLM リクエストスケジューラ
+#
+# プロセス内の全セッションが llm_router を呼ぶ前にここで順番待ちをする。
+# - 優先度クラス：対話ターン > バックグラウンド（要約・先読み生成など） > テスト
+# - 同じ優先度の中ではセッションごとのキューを、トークン量で重み付けした
+#   ラウンドロビン（Deficit Round Robin）で回す。長文を連投する 1 セッションが
+#   他のセッションを飢えさせない。
+# - プロセス全体でトークン / 分の予算（トークンバケット）を守る。
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from cancellation import CancelToken, Cancelled
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_TEST = 2
+
+MAX_INFLIGHT = int(os.getenv("LYRA_MAX_INFLIGHT", "8"))
+TPM_LIMIT = int(os.getenv("LYRA_TPM_LIMIT", "30000"))
+QUANTUM = 1000           # 1 巡でセッションに与えるトークン枠
+_CHARS_PER_TOKEN = 2     # 日本語混じりのざっくり換算
+
+
+def estimate_cost(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """予約するトークン量（プロンプト概算 + 生成上限）。"""
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars // _CHARS_PER_TOKEN + int(max_tokens)
+
+
+@dataclass(eq=False)
+class Ticket:
+    session_id: str
+    priority: int
+    cost: int
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    queue_depth: int = 0      # 並んだ時点で前にいた件数
+    wait_ms: float = 0.0
+    granted: bool = False
+
+
+class RequestScheduler:
+    def __init__(self, max_inflight: int = MAX_INFLIGHT, tpm_limit: int = TPM_LIMIT) -> None:
+        self.max_inflight = max(1, int(max_inflight))
+        self.tpm_limit = max(1, int(tpm_limit))
+        self._cond = threading.Condition()
+        # priority -> (session_id -> そのセッションの待ち行列)。OrderedDict の並びが巡回順
+        self._queues: Dict[int, "OrderedDict[str, Deque[Ticket]]"] = {}
+        self._deficit: Dict[Tuple[int, str], int] = {}
+        self._inflight = 0
+        self._tokens = float(self.tpm_limit)
+        self._refilled_at = time.monotonic()
+
+    # ===== 公開 API =====
+    def acquire(
+        self,
+        session_id: Optional[str],
+        priority: int = PRIORITY_INTERACTIVE,
+        cost: int = 0,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> Ticket:
+        """
+        順番が来るまでブロックし、許可済みのチケットを返す。
+        待っている間に cancel_token が取り消されたら、列から抜けて Cancelled。
+        """
+        # バケット容量を超える予約は、いつまでも通らないので上限に丸める
+        ticket = Ticket(
+            session_id=session_id or "_anonymous",
+            priority=int(priority),
+            cost=min(max(1, int(cost)), self.tpm_limit),
+        )
+        unhook = cancel_token.on_cancel(self._wake) if cancel_token else (lambda: None)
+        try:
+            with self._cond:
+                ticket.queue_depth = self._depth() + self._inflight
+                sessions = self._queues.setdefault(ticket.priority, OrderedDict())
+                sessions.setdefault(ticket.session_id, deque()).append(ticket)
+
+                while True:
+                    self._dispatch()
+                    if ticket.granted:
+                        break
+                    if cancel_token is not None and cancel_token.cancelled:
+                        self._withdraw(ticket)
+                        raise Cancelled(cancel_token.reason or "cancelled")
+                    self._cond.wait(timeout=self._refill_wait(ticket.cost))
+        finally:
+            unhook()
+
+        ticket.wait_ms = round((time.perf_counter() - ticket.enqueued_at) * 1000, 1)
+        return ticket
+
+    def release(self, ticket: Ticket, used_tokens: Optional[int] = None) -> None:
+        """
+        実行枠を返す。実際の使用量が分かれば、予約との差分をバケットに戻す。
+        """
+        with self._cond:
+            if not ticket.granted:
+                self._withdraw(ticket)
+            else:
+                self._inflight -= 1
+                if used_tokens is not None and used_tokens < ticket.cost:
+                    self._tokens = min(
+                        float(self.tpm_limit), self._tokens + (ticket.cost - used_tokens)
+                    )
+                ticket.granted = False
+            self._dispatch()
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            self._refill()
+            return {
+                "queued": self._depth(),
+                "inflight": self._inflight,
+                "tokens_available": round(self._tokens),
+            }
+
+    def _wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    # ===== 内部（_wake 以外は self._cond を持った状態で呼ぶ） =====
+    def _depth(self) -> int:
+        return sum(len(q) for sessions in self._queues.values() for q in sessions.values())
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.tpm_limit),
+            self._tokens + (now - self._refilled_at) * self.tpm_limit / 60.0,
+        )
+        self._refilled_at = now
+
+    def _refill_wait(self, cost: int) -> float:
+        missing = cost - self._tokens
+        if missing <= 0:
+            return 1.0
+        return max(0.05, missing * 60.0 / self.tpm_limit)
+
+    def _dispatch(self) -> None:
+        self._refill()
+        while self._inflight < self.max_inflight:
+            ticket = self._next()
+            if ticket is None:
+                return
+            self._tokens -= ticket.cost
+            self._inflight += 1
+            ticket.granted = True
+            self._cond.notify_all()
+
+    def _next(self) -> Optional[Ticket]:
+        """優先度の高いクラスから、DRR でセッションを巡回して次の 1 件を選ぶ。"""
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            if not sessions:
+                continue
+
+            # 全セッションが枠を使い切るまで巡回（QUANTUM > 0 なので必ず進む）
+            while True:
+                session_id, queue = next(iter(sessions.items()))
+                key = (priority, session_id)
+                head = queue[0]
+                if self._deficit.get(key, 0) >= head.cost:
+                    if head.cost > self._tokens:
+                        # 分あたり予算が足りない。優先度の低いクラスにも回さない
+                        return None
+                    queue.popleft()
+                    self._deficit[key] -= head.cost
+                    if not queue:
+                        del sessions[session_id]
+                        self._deficit.pop(key, None)
+                    return head
+                self._deficit[key] = self._deficit.get(key, 0) + QUANTUM
+                sessions.move_to_end(session_id)
+        return None
+
+    def _withdraw(self, ticket: Ticket) -> None:
+        sessions = self._queues.get(ticket.priority) or {}
+        queue = sessions.get(ticket.session_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del sessions[ticket.session_id]
+                self._deficit.pop((ticket.priority, ticket.session_id), None)
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """プロセス共有のスケジューラ。"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler()
+    return _scheduler
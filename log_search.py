@@ -0,0 +1,392 @@
+# log_search.py — 会話ログの全文検索インデックス
+#
+# 保存ログ（lyra_chat_log.json）や稼働中セッションのメッセージを
+# 転置インデックスに入れ、BM25 で順位付けして返す。
+# - 日本語（かな・漢字）は文字 bigram、英数字は単語単位で分割
+#   （1 文字だけの検索語は、その文字で始まる・終わる bigram をまとめて引く）
+# - ターンが増えても sync_session() で差分だけ追加できる
+# - 画面の検索はセッションごとのインデックス（自分の会話と、自分が追加した保存ログ）だけを見る。
+#   全セッション・全ログをまとめて引くのは運用者向けの CLI だけ
+# - ポスティングは doc_id 昇順の配列なので、頻出語は候補文書だけを二分探索で引く
+# - どの語もありふれている検索では、新しい方から MAX_SCAN 件だけを候補にする
+
+import argparse
+import bisect
+import glob
+import gzip
+import json
+import math
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from blob_store import import_log
+
+
+SEARCH_ROLES = ("user", "assistant")
+
+# BM25 のパラメータ
+_K1 = 1.2
+_B = 0.75
+
+# 1 語あたり全件なめるポスティングの上限（超えたら新しい文書側だけを見る）
+MAX_SCAN = int(os.getenv("LYRA_SEARCH_MAX_SCAN", "10000"))
+
+# 削除済み（入れ直し・リセットで古くなった）文書がこの割合を超えたら詰め直す
+COMPACT_RATIO = 0.5
+
+# セッション専用インデックスを置く session_state のキー
+SESSION_INDEX_KEY = "_search_index"
+
+_CJK = r"぀-ヿ㐀-䶿一-鿿豈-﫿ー"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[0-9a-z]+")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text: str) -> List[str]:
+    """かな・漢字の連なりは文字 bigram（1文字だけなら unigram）、英数字は単語。"""
+    tokens: List[str] = []
+    for run in _TOKEN_RE.findall(_normalize(text)):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+@dataclass
+class SearchHit:
+    session_id: str
+    label: str
+    index: int        # セッション内のメッセージ番号
+    role: str
+    score: float
+    snippet: str
+
+
+class LogSearchIndex:
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        # doc_id -> (session_id, メッセージ番号, role, 本文)
+        self._docs: List[Tuple[str, int, str, str]] = []
+        self._doclen = array("I")
+        self._total_len = 0
+        # term -> (doc_id 配列, 出現回数配列)
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._deleted: Set[int] = set()
+        # かな・漢字 1 文字 -> その文字を含む bigram（1 文字の検索語用）
+        self._by_char: Dict[str, Set[str]] = {}
+        self._sessions: Dict[str, List[int]] = {}   # session_id -> doc_id 一覧
+        self._next_index: Dict[str, int] = {}       # session_id -> 次のメッセージ番号
+        self._labels: Dict[str, str] = {}
+        # session_id -> 最後に取り込んだメッセージ（sync_session で差し替えを見分ける）
+        self._tails: Dict[str, Dict[str, Any]] = {}
+
+    # ===== 追加・削除 =====
+    def add_messages(
+        self,
+        session_id: str,
+        messages: Iterable[Dict[str, Any]],
+        label: Optional[str] = None,
+    ) -> int:
+        """セッションの末尾に追加されたメッセージだけを索引に足す。追加件数を返す。"""
+        added = 0
+        with self._lock:
+            if label:
+                self._labels[session_id] = label
+            for m in messages:
+                idx = self._next_index.get(session_id, 0)
+                self._next_index[session_id] = idx + 1
+                if m.get("role") not in SEARCH_ROLES or not m.get("content"):
+                    continue
+                self._add_doc(session_id, idx, m["role"], m["content"])
+                added += 1
+        return added
+
+    def index_session(
+        self,
+        session_id: str,
+        messages: List[Dict[str, Any]],
+        label: Optional[str] = None,
+    ) -> int:
+        """セッションを丸ごと入れ直す（ログ読込・リセット後など）。"""
+        with self._lock:
+            self.remove_session(session_id)
+            return self.add_messages(session_id, messages, label)
+
+    def sync_session(
+        self,
+        session_id: str,
+        messages: List[Dict[str, Any]],
+        label: Optional[str] = None,
+    ) -> int:
+        """
+        稼働中の会話に索引を追いつかせる。末尾に増えただけなら差分を足し、
+        丸め・リセット・読込で中身が入れ替わっていれば入れ直す。追加件数を返す。
+        """
+        with self._lock:
+            n = self._next_index.get(session_id, 0)
+            if n and (n > len(messages) or messages[n - 1] is not self._tails.get(session_id)):
+                added = self.index_session(session_id, messages, label)
+            else:
+                added = self.add_messages(session_id, messages[n:], label)
+            if messages:
+                self._tails[session_id] = messages[-1]
+            return added
+
+    def remove_session(self, session_id: str) -> None:
+        with self._lock:
+            for doc_id in self._sessions.pop(session_id, []):
+                if doc_id not in self._deleted:
+                    self._deleted.add(doc_id)
+                    self._total_len -= self._doclen[doc_id]
+            self._next_index.pop(session_id, None)
+            self._labels.pop(session_id, None)
+            self._tails.pop(session_id, None)
+            if self._deleted and len(self._deleted) >= len(self._docs) * COMPACT_RATIO:
+                self.compact()
+
+    def compact(self) -> None:
+        """削除済み文書の本文・長さ・ポスティングを捨てて、doc_id を詰め直す。"""
+        with self._lock:
+            if not self._deleted:
+                return
+            remap: Dict[int, int] = {}
+            docs: List[Tuple[str, int, str, str]] = []
+            doclen = array("I")
+            for old, doc in enumerate(self._docs):
+                if old in self._deleted:
+                    continue
+                remap[old] = len(docs)
+                docs.append(doc)
+                doclen.append(self._doclen[old])
+
+            # 生き残った文書の順序は変わらないので、ポスティングは昇順のまま
+            postings: Dict[str, Tuple[array, array]] = {}
+            for term, (ids, tfs) in self._postings.items():
+                new_ids, new_tfs = array("I"), array("H")
+                for doc_id, tf in zip(ids, tfs):
+                    new_id = remap.get(doc_id)
+                    if new_id is not None:
+                        new_ids.append(new_id)
+                        new_tfs.append(tf)
+                if new_ids:
+                    postings[term] = (new_ids, new_tfs)
+
+            self._docs, self._doclen, self._postings = docs, doclen, postings
+            self._by_char = {}
+            for term in postings:
+                self._index_chars(term)
+            self._sessions = {
+                sid: [remap[d] for d in ids] for sid, ids in self._sessions.items()
+            }
+            self._deleted = set()
+
+    def index_log_file(self, path: str) -> int:
+        """保存ログ（新旧どちらの形式でも可）を 1 セッションとして取り込む。"""
+        with open(path, "r", encoding="utf-8") as f:
+            # system は索引に入れないので、参照先が引けなくても空で補えばよい
+            messages = import_log(json.load(f), fallback_system="")
+        return self.index_session(
+            f"file:{os.path.abspath(path)}", messages, label=os.path.basename(path)
+        )
+
+    # ===== 検索 =====
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            n_docs = len(self._docs) - len(self._deleted)
+            if n_docs <= 0:
+                return []
+            avg_len = self._total_len / n_docs
+
+            postings = [(t, p) for t in terms for p in [self._lookup(t)] if p is not None]
+            postings.sort(key=lambda p: len(p[1][0]))
+
+            scores: Dict[int, float] = {}
+            matched: Dict[int, int] = {}
+            for _term, (docs, tfs) in postings:
+                df = len(docs)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                if not scores or df <= len(scores) * 8:
+                    # 希少語：ポスティングを全部なめる（doc_id 昇順なので末尾ほど新しい）
+                    pairs: Iterable[Tuple[int, int]] = zip(docs[-MAX_SCAN:], tfs[-MAX_SCAN:])
+                else:
+                    # 頻出語：既に候補になっている文書だけを二分探索で引く
+                    pairs = self._probe(docs, tfs, scores)
+                for doc_id, tf in pairs:
+                    if doc_id in self._deleted:
+                        continue
+                    norm = _K1 * (1 - _B + _B * self._doclen[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (_K1 + 1) / (tf + norm)
+                    matched[doc_id] = matched.get(doc_id, 0) + 1
+
+            # 多くの語を含む文書を優先し、同数なら BM25 の点数順
+            ranked = sorted(scores, key=lambda d: (matched[d], scores[d]), reverse=True)[:limit]
+            return [self._hit(d, scores[d], query) for d in ranked]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "messages": len(self._docs) - len(self._deleted),
+                "terms": len(self._postings),
+            }
+
+    # ===== 保存・読込 =====
+    def save(self, path: str) -> None:
+        with self._lock:
+            tmp = f"{path}.tmp"
+            with gzip.open(tmp, "wb") as f:
+                pickle.dump(self._state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LogSearchIndex":
+        index = cls()
+        with gzip.open(path, "rb") as f:
+            state = pickle.load(f)
+        index.__dict__.update(state)
+        if "_by_char" not in state:
+            # 1 文字検索に対応する前に保存されたインデックス
+            for term in index._postings:
+                index._index_chars(term)
+        return index
+
+    # ===== 内部 =====
+    def _state(self) -> Dict[str, Any]:
+        return {k: v for k, v in self.__dict__.items() if k not in ("_lock", "_tails")}
+
+    def _add_doc(self, session_id: str, idx: int, role: str, text: str) -> None:
+        doc_id = len(self._docs)
+        tokens = tokenize(text)
+        self._docs.append((session_id, idx, role, text))
+        self._doclen.append(len(tokens))
+        self._total_len += len(tokens)
+        self._sessions.setdefault(session_id, []).append(doc_id)
+
+        counts: Dict[str, int] = {}
+        for t in tokens:
+            counts[t] = counts.get(t, 0) + 1
+        for t, c in counts.items():
+            posting = self._postings.get(t)
+            if posting is None:
+                posting = (array("I"), array("H"))
+                self._postings[t] = posting
+                self._index_chars(t)
+            posting[0].append(doc_id)
+            posting[1].append(min(c, 0xFFFF))
+
+    def _index_chars(self, term: str) -> None:
+        if len(term) == 2 and _CJK_RE.match(term):
+            self._by_char.setdefault(term[0], set()).add(term)
+            self._by_char.setdefault(term[1], set()).add(term)
+
+    def _lookup(self, term: str) -> Optional[Tuple[array, array]]:
+        """
+        語のポスティング。かな・漢字 1 文字なら、単独で現れた分と、
+        その文字を含む bigram の分を文書ごとに足し合わせたものを返す。
+        """
+        if not (len(term) == 1 and _CJK_RE.match(term)):
+            return self._postings.get(term)
+
+        merged: Dict[int, int] = {}
+        for t in (term, *self._by_char.get(term, ())):
+            posting = self._postings.get(t)
+            if posting is None:
+                continue
+            for doc_id, tf in zip(*posting):
+                merged[doc_id] = merged.get(doc_id, 0) + tf
+        if not merged:
+            return None
+        ids = sorted(merged)
+        return array("I", ids), array("H", (min(merged[d], 0xFFFF) for d in ids))
+
+    @staticmethod
+    def _probe(docs: array, tfs: array, candidates: Dict[int, float]) -> List[Tuple[int, int]]:
+        out = []
+        for doc_id in candidates:
+            i = bisect.bisect_left(docs, doc_id)
+            if i < len(docs) and docs[i] == doc_id:
+                out.append((doc_id, tfs[i]))
+        return out
+
+    def _hit(self, doc_id: int, score: float, query: str) -> SearchHit:
+        session_id, idx, role, text = self._docs[doc_id]
+        return SearchHit(
+            session_id=session_id,
+            label=self._labels.get(session_id, session_id),
+            index=idx,
+            role=role,
+            score=round(score, 3),
+            snippet=_snippet(text, query),
+        )
+
+
+def _snippet(text: str, query: str, width: int = 40) -> str:
+    norm = _normalize(text)
+    q = _normalize(query).strip()
+    pos = norm.find(q) if q else -1
+    if pos < 0:
+        for t in tokenize(query):
+            pos = norm.find(t)
+            if pos >= 0:
+                break
+    pos = max(pos, 0)
+    start = max(0, pos - width // 2)
+    out = text[start:start + width * 2].replace("\n", " ")
+    return ("…" if start > 0 else "") + out + ("…" if start + width * 2 < len(text) else "")
+
+
+def get_session_index(state: Any) -> LogSearchIndex:
+    """
+    セッション専用のインデックス。session_state に置くので、ほかのプレイヤーの
+    会話は入らず、セッションが消えれば（退避されれば）一緒に消える。
+    """
+    if SESSION_INDEX_KEY not in state:
+        state[SESSION_INDEX_KEY] = LogSearchIndex()
+    return state[SESSION_INDEX_KEY]
+
+
+# ====== CLI（運用者向け：保存ログのディレクトリをまとめて索引化・検索） ======
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Lyra 会話ログの全文検索")
+    parser.add_argument("--index", required=True, help="インデックスファイル（.pkl.gz）")
+    parser.add_argument("--add", nargs="*", default=[], help="取り込むログ（glob 可）")
+    parser.add_argument("--query", "-q", help="検索語")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    index = LogSearchIndex.load(args.index) if os.path.exists(args.index) else LogSearchIndex()
+    if args.add:
+        for pattern in args.add:
+            for path in glob.glob(pattern, recursive=True):
+                try:
+                    n = index.index_log_file(path)
+                    print(f"indexed {n:5d} messages: {path}")
+                except (OSError, ValueError) as e:
+                    print(f"skip {path}: {e}")
+        index.save(args.index)
+
+    if args.query:
+        for hit in index.search(args.query, args.limit):
+            print(f"{hit.score:7.3f}  {hit.label}#{hit.index} [{hit.role}] {hit.snippet}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,103 @@
 # lyra_core.py
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import time
+import uuid
 import streamlit as st
 
+import profiler
+from cancellation import CancelToken, finish_turn, new_turn_token
+from debug_buffer import get_prompt_buffer
+from llm_cassette import CassetteMiss
+
+SESSION_ID_KEY = "_session_id"
+
+
+def rerun_fragment(full: bool = False) -> None:
+    """
+    フラグメント単独の rerun 中ならそのフラグメントだけを、
+    ページ全体の rerun 中（または full=True）ならページ全体を rerun する。
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    if not full and ctx is not None and ctx.fragment_ids_this_run:
+        st.rerun(scope="fragment")
+    st.rerun()
+
+
+def get_session_id(state) -> str:
+    """セッションを識別する ID（スケジューラの公平キューなどで使う）。"""
+    sid = state.get(SESSION_ID_KEY)
+    if not sid:
+        sid = uuid.uuid4().hex
+        state[SESSION_ID_KEY] = sid
+    return sid
+
+
+def drop_message(messages: List[Dict[str, Any]], message: Dict[str, Any]) -> None:
+    """
+    取り消されたターンで追加したメッセージを外す（同じオブジェクトだけ）。
+    リセットや読み込みで会話が差し替わっていても、新しい会話には触れない。
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i] is message:
+            del messages[i]
+            return
+
+
 class LyraCore:
     """Lyra Engine の中核。1ターンの対話を統括する。"""
 
     def __init__(self, conversation_engine):
         self.conversation = conversation_engine
 
-    def proceed_turn(self, user_text: str, state) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
-        """ユーザー入力を受けて、LLMとの1ターン会話を処理する。"""
+    def proceed_turn(
+        self,
+        user_text: str,
+        state,
+        cancel_token: Optional[CancelToken] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        ユーザー入力を受けて、LLMとの1ターン会話を処理する。
+        cancel_token を省略するとセッション用に新しく発行する
+        （同じセッションで前のターンが走っていればそれは打ち切られる）。
+        """
+        session_id = get_session_id(state)
+        token = cancel_token or new_turn_token(session_id)
+
         # プレイヤーの発言を追加
-        state["messages"].append({"role": "user", "content": user_text})
+        messages = state["messages"]
+        user_message = {"role": "user", "content": user_text}
+        messages.append(user_message)
 
         try:
             # LLM呼び出し
-            reply_text, meta = self.conversation.generate_reply(state["messages"])
+            with profiler.turn_profile("proceed_turn", state):
+                reply_text, meta = self.conversation.generate_reply(
+                    state["messages"],
+                    prompt_buffer=get_prompt_buffer(state),
+                    on_delta=on_delta,
+                    session_id=session_id,
+                    cancel_token=token,
+                )
+        except CassetteMiss:
+            raise
         except Exception as e:
             reply_text = f"⚠️ 応答生成中にエラーが発生しました: {e}"
             meta = {"route": "error", "exception": str(e)}
+        except BaseException:
+            # st.rerun / st.stop（リセット・再読込・切断）で抜けたら生成も止める
+            token.cancel("interrupted")
+            raise
+        finally:
+            finish_turn(session_id, token)
+
+        if meta.get("cancelled"):
+            # 打ち切られたターンの返答は古い会話に混ぜない（返事のない発言も残さない）
+            drop_message(messages, user_message)
+            state["llm_meta"] = meta
+            return state["messages"], meta
 
         # 応答空白時フォールバック
         if not reply_text or not reply_text.strip():
@@ -30,3 +109,75 @@ class LyraCore:
         # メタ情報を保存
         state["llm_meta"] = meta
         return state["messages"], meta
+
+    def proceed_scene_turn(
+        self,
+        user_text: str,
+        state,
+        scene,
+        on_delta: Optional[Callable[[int, str], None]] = None,
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        シーンモードの1ターン。scene（SceneConversation）の全メンバーが
+        並列に応答し、メンバー順に assistant メッセージとして追加される。
+        """
+        session_id = get_session_id(state)
+        token = new_turn_token(session_id)
+        messages = state["messages"]
+        user_message = {"role": "user", "content": user_text}
+        messages.append(user_message)
+
+        t0 = time.perf_counter()
+        try:
+            with profiler.turn_profile("proceed_scene_turn", state):
+                replies = scene.generate_replies(
+                    state["messages"],
+                    prompt_buffer=get_prompt_buffer(state),
+                    on_delta=on_delta,
+                    session_id=session_id,
+                    cancel_token=token,
+                )
+        except CassetteMiss:
+            token.cancel("cassette_miss")
+            raise
+        except Exception as e:
+            token.cancel("error")
+            replies = []
+            state["messages"].append({
+                "role": "assistant",
+                "content": f"⚠️ 応答生成中にエラーが発生しました: {e}",
+            })
+        except BaseException:
+            # 呼び出し元が抜けても、ワーカースレッドの生成は続いてしまうので止める
+            token.cancel("interrupted")
+            raise
+        finally:
+            finish_turn(session_id, token)
+
+        members_meta = []
+        answered = False
+        for member, reply_text, meta in replies:
+            if meta.get("cancelled"):
+                members_meta.append(dict(meta, char_id=member.char_id))
+                continue
+            if not reply_text or not reply_text.strip():
+                reply_text = "……うまく返答を生成できなかったみたい。もう一度試してくれる？"
+            state["messages"].append({
+                "role": "assistant",
+                "content": reply_text,
+                "speaker": member.name,
+            })
+            answered = True
+            members_meta.append(dict(meta, char_id=member.char_id))
+
+        if replies and not answered:
+            # 全員の応答が取り消された。返事のない発言は残さない
+            drop_message(messages, user_message)
+
+        meta = {
+            "route": "scene",
+            "members": members_meta,
+            "latency_ms": round((time.perf_counter() - t0) * 1000, 1),
+        }
+        state["llm_meta"] = meta
+        return state["messages"], meta
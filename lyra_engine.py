@@ -1,14 +1,21 @@
 # lyra_engine.py — Lyra Engine main entrypoint
 
+import html
 import os
 from typing import Any, Dict, List
 
 import streamlit as st
 
+from personas import PERSONA_MAP
 from personas.persona_floria_ja import get_persona
-from components import PreflightChecker, DebugPanel, ChatLog, PlayerInput
+from components import PreflightChecker, DebugPanel, ChatLog, PlayerInput, SearchPanel
 from conversation_engine import LLMConversation
-from lyra_core import LyraCore
+from output_guard import rules_for_persona
+from lyra_core import LyraCore, rerun_fragment
+from opening_pool import get_opening_pool
+from scene_engine import SceneConversation
+from session_manager import get_session_manager
+import profiler
 
 
 # ページ全体の基本設定
@@ -40,6 +47,7 @@ st.markdown(
 class LyraEngine:
     MAX_LOG = 500
     DISPLAY_LIMIT = 20000
+    RENDERED_KEY = "_log_rendered_upto"   # ページ全体の描画で出した messages の件数
 
     def __init__(self):
         # ペルソナの取得（現時点ではフローリア固定）
@@ -77,6 +85,8 @@ class LyraEngine:
             temperature=0.7,
             max_tokens=800,
             style_hint=self.style_hint,  # ← ★ personaのstyle_hintを反映
+            output_rules=rules_for_persona(persona),
+            persona_key=persona.char_id,
         )
 
         # コア（1ターン会話制御）
@@ -87,15 +97,25 @@ class LyraEngine:
         self.debug_panel = DebugPanel()
         self.chat_log = ChatLog(self.partner_name, self.DISPLAY_LIMIT)
         self.player_input = PlayerInput()
+        self.search_panel = SearchPanel()
 
         # セッション状態の初期化
         self._init_session_state()
 
     # ===== セッション初期化 =====
     def _init_session_state(self) -> None:
+        # 退避済みなら会話を戻す（ほかのアイドルセッションの退避もここで行う）
+        get_session_manager().touch(st.session_state)
+
         if "messages" not in st.session_state:
             st.session_state["messages"] = []
-            if self.starter_hint:
+            # 作り置きの挨拶があれば、LLM を待たずにそれで始める
+            opening = get_opening_pool().take(self.conversation)
+            if opening is not None:
+                text, meta = opening
+                st.session_state["messages"].append({"role": "assistant", "content": text})
+                st.session_state["llm_meta"] = meta
+            elif self.starter_hint:
                 st.session_state["messages"].append(
                     {"role": "assistant", "content": self.starter_hint}
                 )
@@ -119,32 +139,100 @@ class LyraEngine:
         # デバッグパネル（サイドバー）
         llm_meta = self.state.get("llm_meta")
         with st.sidebar:
+            # 2人以上選ぶとシーンモード（全員が同じターンに並列で応答）
+            scene_ids = st.multiselect(
+                "シーンに参加するペルソナ",
+                list(PERSONA_MAP.keys()),
+                default=list(PERSONA_MAP.keys())[:1],
+                key="scene_members",
+            )
             self.debug_panel.render(llm_meta)
+            self.search_panel.render(self.partner_name)
 
-        # ① 現在の会話ログを表示
+        # ① 現在の会話ログを表示（ページ全体の rerun でだけ描く）
         messages: List[Dict[str, str]] = self.state.get("messages", [])
-        self.chat_log.render(messages)
+        with profiler.span("chat_log.render"):
+            self.chat_log.render(messages)
+        self.state[self.RENDERED_KEY] = len(messages)
+
+        # ② 入力欄と最新の吹き出し（送信・ストリーミングはこの中だけで rerun する）
+        self.render_turn(scene_ids)
+
+        # 描画を終えてから、次に来る新しいセッションのための挨拶を補充する
+        get_opening_pool().warm(self.conversation)
+
+    @st.fragment
+    def render_turn(self, scene_ids: List[str]) -> None:
+        with profiler.fragment_profile("render_turn", self.state):
+            # フラグメントだけの rerun でも操作中として扱う（退避されていれば戻す）
+            get_session_manager().touch(self.state)
+
+            # 前回のページ全体の描画より後に増えた吹き出し
+            messages: List[Dict[str, str]] = self.state.get("messages", [])
+            self.chat_log.render_bubbles(messages[self.state.get(self.RENDERED_KEY, 0):])
+
+            # プレイヤー入力欄
+            user_text = self.player_input.render()
+            if not user_text:
+                return
+            self._run_turn(user_text, scene_ids)
+
+            # デバッグパネル（サイドバー＝フラグメントの外）を開いているときだけページ全体
+            rerun_fragment(full=bool(self.state.get("debug_panel_show")))
+
+    def _run_turn(self, user_text: str, scene_ids: List[str]) -> None:
+        if len(scene_ids) > 1:
+            scene = SceneConversation(
+                scene_ids,
+                temperature=self.conversation.temperature,
+                max_tokens=self.conversation.max_tokens,
+            )
+            # メンバー順に吹き出しの枠を先に用意し、届いた順ではなく並び順で流し込む
+            slots = [st.empty() for _ in scene.members]
+
+            def show_partial(i: int, text: str) -> None:
+                name = html.escape(scene.members[i].name)
+                slots[i].markdown(
+                    f"<div class='chat-bubble assistant'><b>{name}：</b><br>{html.escape(text)}</div>",
+                    unsafe_allow_html=True,
+                )
 
-        # ② プレイヤー入力欄
-        user_text = self.player_input.render()
+            with st.spinner("みんなが返事を考えています…"):
+                updated_messages, meta = self.core.proceed_scene_turn(
+                    user_text,
+                    self.state,
+                    scene,
+                    on_delta=show_partial,
+                )
+        else:
+            # 途中経過を描画しておくと、描画のたびに Streamlit が停止要求
+            # （リロード・タブを閉じる）を拾えるので、生成も即座に打ち切れる
+            live = st.empty()
+            partner = html.escape(self.partner_name)
+
+            def show_partial(text: str) -> None:
+                live.markdown(
+                    f"<div class='chat-bubble assistant'><b>{partner}：</b><br>{html.escape(text)}</div>",
+                    unsafe_allow_html=True,
+                )
 
-        if user_text:
             with st.spinner("フローリアが返事を考えています…"):
                 updated_messages, meta = self.core.proceed_turn(
                     user_text,
                     self.state,
+                    on_delta=show_partial,
                 )
 
-            # セッション更新
-            self.state["messages"] = updated_messages
-            self.state["llm_meta"] = meta
-
-            # （必要ならスクロール用のフラグもここで立てる）
-            # self.state["scroll_to_input"] = True
+        # セッション更新
+        self.state["messages"] = updated_messages
+        self.state["llm_meta"] = meta
 
-            st.rerun()
+        # （必要ならスクロール用のフラグもここで立てる）
+        # self.state["scroll_to_input"] = True
 
 # ===== エントリーポイント =====
 if __name__ == "__main__":
-    engine = LyraEngine()
-    engine.render()
+    with profiler.rerun_profile("lyra_engine", st.session_state):
+        with profiler.span("LyraEngine.__init__"):
+            engine = LyraEngine()
+        engine.render()
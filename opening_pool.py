@@ -0,0 +1,158 @@
+# opening_pool.py — 新しいセッションの最初の挨拶を、先回りして作り置きしておく
+#
+# ユーザーがまだ何も発言していないときのプロンプト（ペルソナ＋自己紹介の依頼）は
+# どのセッションでも同じなので、その応答をペルソナごとに数件プールしておく。
+# - プールはバックグラウンドのスレッドで、スケジューラの低優先度枠を使って補充する
+# - 画面の描画が終わるたびに warm() で補充し、同じ文面は重ねて持たない（挨拶がばらつくように）
+# - 冒頭プロンプトのハッシュが変わったら（人格・文体指針の変更）、古い作り置きは捨てる
+# - 補充に失敗したら（キー未設定・障害・429 など）、間隔を倍々に空けるまで warm() しても試さない
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+from conversation_engine import LLMConversation
+from debug_buffer import prompt_hash
+from llm_scheduler import PRIORITY_BACKGROUND
+
+
+POOL_SIZE = int(os.getenv("LYRA_OPENING_POOL_SIZE", "3"))   # 0 で無効
+POOL_SESSION_ID = "_opening_pool"   # スケジューラ上のセッション名
+RETRY_BASE_SEC = float(os.getenv("LYRA_OPENING_RETRY_SEC", "30"))       # 失敗後、最初に待つ秒数
+RETRY_MAX_SEC = float(os.getenv("LYRA_OPENING_RETRY_MAX_SEC", "1800"))  # 待ち時間の上限
+
+Opening = Tuple[str, Dict[str, Any]]
+
+
+class OpeningPool:
+    def __init__(self, size: int = POOL_SIZE) -> None:
+        self.size = max(0, int(size))
+        self._lock = threading.Lock()
+        self._ready: Dict[str, Deque[Opening]] = {}   # persona_key -> 作り置き
+        self._keys: Dict[str, str] = {}               # persona_key -> 作り置きの冒頭プロンプト
+        self._filling: Set[str] = set()
+        self._failures: Dict[str, int] = {}           # persona_key -> 連続失敗回数
+        self._retry_at: Dict[str, float] = {}         # persona_key -> 次に補充を試してよい時刻
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def take(self, conversation: LLMConversation) -> Optional[Opening]:
+        """
+        作り置きの挨拶を 1 件取り出す（なければ None）。
+        補充はここでは始めず、画面側が描画を終えてから warm() で行う
+        （初回描画と openai の読み込み・生成スレッドを競わせないため）。
+        """
+        if self.size <= 0:
+            return None
+        with self._lock:
+            ready = self._sync(conversation)
+            item = ready.popleft() if ready else None
+        if item is None:
+            return None
+        text, meta = item
+        return text, dict(meta, opening_pool=True)
+
+    def warm(self, conversation: LLMConversation) -> None:
+        """
+        プールが満杯でなければ、バックグラウンドで補充を始める。
+        直前の補充が失敗していたら、待ち時間が明けるまでは何もしない。
+        """
+        if self.size <= 0:
+            return
+        persona_key = conversation.persona_key
+        with self._lock:
+            ready = self._sync(conversation)
+            if len(ready) >= self.size or persona_key in self._filling:
+                return
+            if time.monotonic() < self._retry_at.get(persona_key, 0.0):
+                return
+            self._filling.add(persona_key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="lyra-opening"
+                )
+            key = self._keys[persona_key]
+        self._executor.submit(self._fill, conversation, key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {k: len(v) for k, v in self._ready.items()}
+
+    def failures(self, persona_key: str) -> int:
+        """補充の連続失敗回数（成功すると 0 に戻る）。"""
+        with self._lock:
+            return self._failures.get(persona_key, 0)
+
+    # ===== 内部（_sync は self._lock を持った状態で呼ぶ） =====
+    def _sync(self, conversation: LLMConversation) -> Deque[Opening]:
+        persona_key = conversation.persona_key
+        key = prompt_hash(conversation.build_messages([]))
+        if self._keys.get(persona_key) != key:
+            # 人格や文体指針が変わった。前のプロンプトで作った挨拶は使わない
+            self._keys[persona_key] = key
+            self._ready[persona_key] = deque()
+        return self._ready[persona_key]
+
+    def _backoff(self, persona_key: str) -> None:
+        n = self._failures.get(persona_key, 0) + 1
+        self._failures[persona_key] = n
+        delay = min(RETRY_MAX_SEC, RETRY_BASE_SEC * (2 ** min(n - 1, 32)))
+        self._retry_at[persona_key] = time.monotonic() + delay
+
+    def _fill(self, conversation: LLMConversation, key: str) -> None:
+        persona_key = conversation.persona_key
+        failed = True
+        try:
+            # 同じ文面ばかり返ってきても回り続けないよう、試行回数に上限を設ける
+            for _ in range(self.size * 2):
+                with self._lock:
+                    ready = self._ready.get(persona_key)
+                    if self._keys.get(persona_key) != key or ready is None or len(ready) >= self.size:
+                        failed = False
+                        return
+
+                # 短い自己紹介をペルソナの応答長に混ぜると、新しいセッションの最初の返答が切れる
+                text, meta = conversation.generate_reply(
+                    [], session_id=POOL_SESSION_ID, priority=PRIORITY_BACKGROUND, learn=False
+                )
+                if meta.get("route") in ("error", "cancelled") or not text.strip():
+                    # キー未設定・API 障害など。待ち時間が明けてから warm() されたときにまた試す
+                    failed = True
+                    return
+                failed = False
+
+                with self._lock:
+                    if self._keys.get(persona_key) != key:
+                        return
+                    ready = self._ready[persona_key]
+                    if all(text != t for t, _ in ready):
+                        ready.append((text, meta))
+            # 試行回数を使い切っても埋まらない（同じ文面ばかり返ってくる）ときも間を空ける
+            failed = True
+        except Exception:
+            # 作り置きは失敗しても困らない（通常どおりの開始になるだけ）
+            failed = True
+        finally:
+            with self._lock:
+                self._filling.discard(persona_key)
+                if failed:
+                    self._backoff(persona_key)
+                else:
+                    self._failures.pop(persona_key, None)
+                    self._retry_at.pop(persona_key, None)
+
+
+_pool: Optional[OpeningPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_opening_pool() -> OpeningPool:
+    """プロセス共有の作り置きプール。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = OpeningPool()
+    return _pool
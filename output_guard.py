@@ -0,0 +1,195 @@
+# output_guard.py — ストリーミング出力をペルソナの出力規則で検査するガード
+
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancelToken, Cancelled
+from llm_router import CassetteMiss, stream_with_fallback
+from llm_scheduler import PRIORITY_INTERACTIVE
+
+
+# 違反で打ち切ったあと、引き締めた指示で取り直す回数
+MAX_GUARD_RETRIES = 1
+
+
+@dataclass(frozen=True)
+class OutputRules:
+    line_prefixes: Tuple[str, ...] = ()  # 行頭に来たら取り除く記号（修復可能）
+    patterns: Tuple[str, ...] = ()       # 出たら打ち切る正規表現（修復不能）
+
+    def __bool__(self) -> bool:
+        return bool(self.line_prefixes or self.patterns)
+
+
+def rules_for_persona(persona: Any) -> OutputRules:
+    return OutputRules(
+        line_prefixes=tuple(getattr(persona, "forbidden_line_prefixes", ()) or ()),
+        patterns=tuple(getattr(persona, "forbidden_patterns", ()) or ()),
+    )
+
+
+class GuardViolation(Exception):
+    def __init__(self, pattern: str, excerpt: str) -> None:
+        super().__init__(f"出力規則違反: {pattern!r} ({excerpt!r})")
+        self.pattern = pattern
+        self.excerpt = excerpt
+
+
+class OutputGuard:
+    """
+    差分テキストを1文字ずつ見て、
+    - 行頭の装飾記号（とその直後の空白）はその場で取り除く
+    - patterns に当たる行が出たら GuardViolation（strict=False なら記録だけ）
+    """
+
+    _SPACES = " \t　"
+
+    def __init__(self, rules: OutputRules, strict: bool = True) -> None:
+        self.rules = rules
+        self.strict = strict
+        self.repairs = 0
+        self.violations: List[str] = []
+        self._compiled = [re.compile(p) for p in rules.patterns]
+        self._at_line_start = True
+        self._pending = ""     # 行頭の空白（記号が来るか分かるまで保留）
+        self._stripped = False  # この行頭で記号を取り除いたか
+        self._line = ""
+
+    def feed(self, delta: str) -> str:
+        """差分を受け取り、修復済みで出してよいテキストを返す。"""
+        if not self.rules:
+            return delta
+
+        out: List[str] = []
+        for ch in delta:
+            if self._at_line_start:
+                if ch in self._SPACES:
+                    self._pending += ch
+                    continue
+                if ch in self.rules.line_prefixes:
+                    self.repairs += 1
+                    self._pending = ""
+                    self._stripped = True
+                    continue
+                if not self._stripped:
+                    out.append(self._pending)
+                self._pending = ""
+                self._stripped = False
+                if ch != "\n":
+                    self._at_line_start = False
+
+            out.append(ch)
+            if ch == "\n":
+                # 行が閉じた時点で検査する（同じ差分の中で改行まで来た行も見逃さない）
+                self._check_line()
+                self._at_line_start = True
+                self._line = ""
+            else:
+                self._line += ch
+
+        # 書きかけの行も、違反が見えた時点で打ち切れるよう毎回見る
+        self._check_line()
+        return "".join(out)
+
+    def finish(self) -> str:
+        """ストリーム終端。保留中の行頭空白を吐き出す。"""
+        tail = "" if self._stripped else self._pending
+        self._pending = ""
+        return tail
+
+    def _check_line(self) -> None:
+        for rx in self._compiled:
+            m = rx.search(self._line)
+            if not m:
+                continue
+            if self.strict:
+                raise GuardViolation(rx.pattern, m.group(0))
+            if rx.pattern not in self.violations:
+                self.violations.append(rx.pattern)
+
+
+def _tightened(messages: List[Dict[str, str]], v: GuardViolation) -> List[Dict[str, str]]:
+    """違反内容を添えて、system に出力規則の念押しを追記したプロンプトを返す。"""
+    note = (
+        f"\n\n（注意：直前の出力は「{v.excerpt}」のような表記を含んだため破棄されました。"
+        "見出し・箇条書き・行頭の記号・英語のタグやラベルは一切使わず、"
+        "日本語の地の文と会話文だけで書いてください。）"
+    )
+    head = dict(messages[0], content=messages[0]["content"] + note)
+    return [head] + messages[1:]
+
+
+def generate_guarded(
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    rules: OutputRules,
+    on_delta: Optional[Callable[[str], None]] = None,
+    session_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    cancel_token: Optional[CancelToken] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    ストリーミングで生成しながらガードを通す。
+    修復不能な違反が出た時点で接続を切り、引き締めた指示で取り直す。
+    最後の試行だけは打ち切らず、修復だけして返す。
+    on_delta には「ここまでの修復済み全文」を渡す（取り直し時は空からやり直し）。
+    cancel_token が取り消されたら、その時点までの本文と meta["cancelled"] を返す。
+    """
+    guard_meta: Dict[str, Any] = {"repairs": 0, "retries": 0, "aborted": []}
+    prompt = messages
+
+    for attempt in range(MAX_GUARD_RETRIES + 1):
+        last = attempt == MAX_GUARD_RETRIES
+        guard = OutputGuard(rules, strict=not last)
+        text = ""
+
+        try:
+            stream = stream_with_fallback(
+                prompt,
+                temperature,
+                max_tokens,
+                session_id=session_id,
+                priority=priority,
+                cancel_token=cancel_token,
+            )
+        except CassetteMiss:
+            raise
+        except Cancelled as e:
+            return "", {"route": "cancelled", "cancelled": str(e), "guard": guard_meta}
+        except Exception as e:
+            return "", {"route": "error", "gpt_error": str(e), "guard": guard_meta}
+
+        try:
+            for delta in stream:
+                text += guard.feed(delta)
+                if on_delta is not None:
+                    on_delta(text)
+            text += guard.finish()
+        except GuardViolation as v:
+            stream.close()
+            guard_meta["repairs"] += guard.repairs
+            guard_meta["retries"] += 1
+            guard_meta["aborted"].append({
+                "pattern": v.pattern,
+                "excerpt": v.excerpt,
+                "chars_generated": len(text),
+                "usage": stream.usage,  # 打ち切りまでに使った分（概算）
+            })
+            prompt = _tightened(messages, v)
+            continue
+        except Exception as e:
+            return text, {"route": "error", "gpt_error": str(e), "guard": guard_meta}
+        finally:
+            # 違反・例外（st.rerun 含む）で抜けたときは残りを生成させずに切る
+            stream.close()
+
+        guard_meta["repairs"] += guard.repairs
+        guard_meta["violations"] = guard.violations
+        meta = dict(stream.meta)
+        meta["guard"] = guard_meta
+        return text, meta
+
+    # ここには来ない（最後の試行は strict=False）
+    return "", {"route": "error", "guard": guard_meta}
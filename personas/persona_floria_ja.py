@@ -1,6 +1,7 @@
 # persona_floria_ja.py — Lyra Engine / Floria persona (Japanese)
 
 from dataclasses import dataclass
+from typing import Tuple
 
 
 @dataclass
@@ -10,6 +11,11 @@ class Persona:
     system_prompt: str  # LLM用のシステムプロンプト
     starter_hint: str   # 入力ヒント（あれば）
     style_hint: str = ""  # 文体・感情トーン指示（任意）
+    # 出力ガード用の規則（任意）
+    forbidden_line_prefixes: Tuple[str, ...] = ()  # 行頭に付いたら取り除く記号
+    forbidden_patterns: Tuple[str, ...] = ()       # 出たら生成を打ち切る正規表現
+    # シーンモードでの 1 レスのトークン予算（0 なら共通の上限）
+    max_tokens: int = 0
 
 
 FLORIA_JA = Persona(
@@ -42,6 +48,10 @@ FLORIA_JA = Persona(
         "感情表現は繊細で、愛しさや安心感を感じさせる方向に寄せる。\n"
         "見出しや記号を使わず、純粋な日本語の文章のみで応答する。"
     ),
+    forbidden_line_prefixes=("*", "・", "•", "★", "#"),
+    forbidden_patterns=(
+        r"[A-Za-z][A-Za-z_\-]{2,}\s*[:：]",  # onstage: / onscreen: などの英語タグ
+    ),
 )
 
 
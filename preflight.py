@@ -1,6 +1,6 @@
 # preflight.py — Lyra Engine / Preflight Diagnostics
 
-import os, requests
+import os
 from dataclasses import dataclass
 from typing import Dict
 
@@ -19,6 +19,8 @@ class PreflightChecker:
         if not self.openai_key:
             return CheckResult(False, "OPENAI_API_KEY が設定されていません。")
 
+        import requests  # 診断を実行するときだけ読み込む
+
         url = "https://api.openai.com/v1/models"
         headers = {"Authorization": f"Bearer {self.openai_key}"}
         try:
@@ -40,6 +42,8 @@ class PreflightChecker:
         if not self.openrouter_key:
             return CheckResult(False, "OPENROUTER_API_KEY が設定されていません。")
 
+        import requests
+
         url = "https://openrouter.ai/api/v1/models"
         headers = {"Authorization": f"Bearer {self.openrouter_key}"}
         try:
@@ -0,0 +1,434 @@
+# profiler.py — rerun / ターン単位のオプトイン・プロファイラ
+
+import argparse
+import cProfile
+import glob
+import json
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+# ====== 設定 ======
+# LYRA_PROFILE=1       : すべての rerun を計測
+# LYRA_PROFILE_TURNS=1 : proceed_turn 単体も cProfile で計測
+PROFILE_ENV = "LYRA_PROFILE"
+PROFILE_TURNS_ENV = "LYRA_PROFILE_TURNS"
+PROFILE_DIR = os.getenv("LYRA_PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("LYRA_PROFILE_KEEP", "20"))  # ローテーションで残すファイル数
+TOP_N = 15
+
+# 起動時間の予算（ms）と、初回描画までに読み込まれていてはいけないモジュール
+# （最初のメッセージ送信や診断ボタンで初めて必要になるもの）
+STARTUP_BUDGET_MS = int(os.getenv("LYRA_STARTUP_BUDGET_MS", "1000"))
+DEFERRED_MODULES = ("openai", "requests")
+
+# フラグメント本体の区間名に付ける接頭辞（ページ全体の rerun の内訳で見分ける）
+FRAGMENT_PREFIX = "fragment:"
+
+# session_state のキー（サイドバーのトグル / 最後の計測結果）
+STATE_KEY = "_profile_enabled"
+RESULT_KEY = "_profile_last"
+TURN_RESULT_KEY = "_profile_last_turn"
+
+# 計測中のレコーダはスクリプト実行スレッドごとに持つ
+_local = threading.local()
+
+
+class _Recorder:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.spans: List[Dict[str, Any]] = []
+
+
+def is_enabled(state: Optional[Any] = None) -> bool:
+    """環境変数またはサイドバーのトグルで計測が有効か。"""
+    if os.getenv(PROFILE_ENV) == "1":
+        return True
+    return bool(state is not None and state.get(STATE_KEY))
+
+
+def turns_enabled() -> bool:
+    return os.getenv(PROFILE_TURNS_ENV) == "1"
+
+
+# ====== 区間計測 ======
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    壁時計での区間計測。計測中の rerun がなければ何もしない
+    （スレッドローカルを1回見るだけ）。
+    """
+    rec: Optional[_Recorder] = getattr(_local, "recorder", None)
+    if rec is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec.spans.append(
+            {"name": name, "ms": round((time.perf_counter() - t0) * 1000, 2)}
+        )
+
+
+# ====== rerun / ターン全体の計測 ======
+@contextmanager
+def rerun_profile(name: str, state: Optional[Any] = None) -> Iterator[None]:
+    """
+    1回の rerun を cProfile + 壁時計 + tracemalloc で包む。
+    結果は PROFILE_DIR に書き出し、要約を state[RESULT_KEY] に残す。
+    st.rerun() / st.stop() による脱出でも finally で確実に閉じる。
+    """
+    if not is_enabled(state):
+        yield
+        return
+
+    summary: Dict[str, Any] = {}
+    try:
+        with _profiled(name) as summary:
+            yield
+    finally:
+        # st.rerun() などの制御例外で抜けた場合も要約は残す
+        if state is not None and summary:
+            state[RESULT_KEY] = summary
+
+
+@contextmanager
+def turn_profile(name: str, state: Optional[Any] = None) -> Iterator[None]:
+    """
+    proceed_turn 1回分の計測。
+    - rerun 計測中なら区間として記録するだけ（cProfile は入れ子にできない）
+    - LYRA_PROFILE_TURNS=1 なら単独で cProfile を取る
+    """
+    if getattr(_local, "recorder", None) is not None:
+        with span(name):
+            yield
+        return
+
+    if not turns_enabled():
+        yield
+        return
+
+    summary: Dict[str, Any] = {}
+    try:
+        with _profiled(name) as summary:
+            yield
+    finally:
+        # st.rerun() などの制御例外で抜けた場合も要約は残す
+        if state is not None and summary:
+            state[TURN_RESULT_KEY] = summary
+
+
+@contextmanager
+def fragment_profile(name: str, state: Optional[Any] = None) -> Iterator[None]:
+    """
+    st.fragment の本体用。
+    - ページ全体の rerun の中で呼ばれたら、区間として記録するだけ
+    - フラグメント単独の rerun なら、rerun_profile と同じく 1 回分を計測する
+    """
+    if getattr(_local, "recorder", None) is not None:
+        with span(FRAGMENT_PREFIX + name):
+            yield
+        return
+
+    with rerun_profile(name, state):
+        yield
+
+
+# tracemalloc はプロセス全体で 1 つしかないので、メモリを測る計測は同時に 1 つだけにする
+# （重なった rerun は時間とホットスポットだけ取る。止める・ピークを戻すで他の計測を壊さない）
+_trace_lock = threading.Lock()
+
+
+@contextmanager
+def _profiled(name: str) -> Iterator[Dict[str, Any]]:
+    summary: Dict[str, Any] = {"name": name}
+    rec = _Recorder(name)
+    _local.recorder = rec
+
+    tracing = _trace_lock.acquire(blocking=False)
+    started_tracing = False
+    if tracing:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    prof: Optional[cProfile.Profile] = cProfile.Profile()
+    t0 = time.perf_counter()
+    try:
+        prof.enable()
+    except ValueError:
+        # 別スレッドのプロファイラが動いている（Python 3.12 以降は同時に 1 つだけ）
+        prof = None
+    try:
+        yield summary
+    finally:
+        if prof is not None:
+            prof.disable()
+        wall_ms = (time.perf_counter() - t0) * 1000
+        _local.recorder = None
+
+        current = peak = None
+        snapshot = None
+        if tracing:
+            try:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+            except RuntimeError:
+                # 計測の外で tracemalloc を止められた。メモリの項目は空のまま
+                current = peak = snapshot = None
+            finally:
+                _trace_lock.release()
+
+        summary.update({
+            "wall_ms": round(wall_ms, 2),
+            "spans": rec.spans,
+            "mem_current_kb": None if current is None else round(current / 1024, 1),
+            "mem_peak_kb": None if peak is None else round(peak / 1024, 1),
+            "mem_top": _memory_top(snapshot) if snapshot is not None else [],
+            "hotspots": _hotspots(prof) if prof is not None else [],
+            "file": _dump(prof, name) if prof is not None else None,
+        })
+
+
+def caption(summary: Dict[str, Any]) -> str:
+    """DebugPanel などに出す 1 行の要約。"""
+    peak = summary.get("mem_peak_kb")
+    mem = f"peak {peak} KB" if peak is not None else "peak -（他の計測と重なったため省略）"
+    return f"{summary['wall_ms']} ms / {mem} / {summary.get('file') or '(未保存)'}"
+
+
+# ====== 集計・書き出し ======
+def _hotspots(prof: cProfile.Profile, limit: int = TOP_N) -> List[Dict[str, Any]]:
+    stats = pstats.Stats(prof)
+    rows = []
+    for (filename, lineno, func), (cc, nc, tt, ct, _callers) in stats.stats.items():
+        rows.append({
+            "func": f"{os.path.basename(filename)}:{lineno}({func})",
+            "calls": nc,
+            "tottime_ms": round(tt * 1000, 2),
+            "cumtime_ms": round(ct * 1000, 2),
+        })
+    rows.sort(key=lambda r: r["cumtime_ms"], reverse=True)
+    return rows[:limit]
+
+
+def _memory_top(snapshot: tracemalloc.Snapshot, limit: int = 5) -> List[Dict[str, Any]]:
+    out = []
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        out.append({
+            "where": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        })
+    return out
+
+
+def _dump(prof: cProfile.Profile, name: str) -> Optional[str]:
+    """PROFILE_DIR に .prof を書き、古いものから PROFILE_KEEP 件を超えた分を消す。"""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(
+            PROFILE_DIR, f"{name}-{stamp}-{int(time.time() * 1000) % 1000:03d}.prof"
+        )
+        prof.dump_stats(path)
+
+        files = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.prof")), key=os.path.getmtime)
+        for old in files[:-PROFILE_KEEP]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return path
+    except OSError:
+        return None
+
+
+# ====== 起動時間の計測（コールドスタート） ======
+_STARTUP_PROBE = """
+import json, os, sys, time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+t1 = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+at.secrets["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY") or "sk-startup-probe"
+at.run()
+t2 = time.perf_counter()
+print(json.dumps({
+    "streamlit_import_ms": round((t1 - t0) * 1000, 1),
+    "first_render_ms": round((t2 - t1) * 1000, 1),
+    "exception": [str(e.value) for e in at.exception],
+    "loaded": sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules),
+}))
+"""
+
+
+def measure_startup(script: str) -> Dict[str, Any]:
+    """
+    新しいプロセスで script を初回描画まで（AppTest で 1 回）走らせ、
+    import と初回描画の時間、読み込まれてしまった遅延対象モジュールを返す。
+    キャッシュの効いていないコンテナ起動に近づけるため、毎回別プロセスで測る。
+    """
+    path = os.path.abspath(script)
+    # 挨拶の作り置きは描画後にバックグラウンドで openai を読み込むので、計測では止める
+    env = dict(os.environ, LYRA_OPENING_POOL_SIZE="0")
+    proc = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE, path, json.dumps(DEFERRED_MODULES)],
+        cwd=os.path.dirname(path),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} の起動計測に失敗しました:\n{proc.stderr}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["script"] = script
+    result["total_ms"] = round(result["streamlit_import_ms"] + result["first_render_ms"], 1)
+    return result
+
+
+# ====== rerun の計測（ページ全体 vs フラグメント単独） ======
+_RERUN_PROBE = """
+import functools, json, os, sys
+from streamlit.testing.v1 import AppTest
+import streamlit.testing.v1.local_script_runner as local_runner
+import profiler
+script, turns, repeat = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+at = AppTest.from_file(script, default_timeout=60)
+at.secrets["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY") or "sk-rerun-probe"
+messages = [{"role": "system", "content": "system"}]
+for i in range(turns):
+    messages.append({"role": "user", "content": f"{i} 番目の問いかけ。" * 8})
+    messages.append({"role": "assistant", "content": f"{i} 番目の返事です。湖のほとりで。" * 20})
+at.session_state["messages"] = messages
+at.session_state[profiler.STATE_KEY] = True
+at.run()
+
+def run_fragment(fragment_id):
+    # フラグメント内のボタンを押したときと同じく、そのフラグメントだけを rerun する
+    rerun_data = local_runner.RerunData
+    local_runner.RerunData = functools.partial(rerun_data, fragment_id_queue=[fragment_id])
+    try:
+        at.run()
+    finally:
+        local_runner.RerunData = rerun_data
+    if profiler.RESULT_KEY not in at.session_state:
+        return None
+    return at.session_state[profiler.RESULT_KEY]
+
+rows = []
+for _ in range(repeat):
+    at.run()
+    row = {"full_ms": at.session_state[profiler.RESULT_KEY]["wall_ms"], "fragments": {}}
+    for fragment_id in list(at._fragment_storage._fragments):
+        # 送信直後と同じく、前回のページ全体の描画より後に 1 往復ぶん増えた状態にする
+        at.session_state["messages"] = messages + [
+            {"role": "user", "content": "送信した問いかけ。"},
+            {"role": "assistant", "content": "届いた返事です。"},
+        ]
+        if profiler.RESULT_KEY in at.session_state:
+            del at.session_state[profiler.RESULT_KEY]
+        # fragment_profile で包んだフラグメントだけが、単独 rerun の計測結果を残す
+        summary = run_fragment(fragment_id)
+        if summary is not None:
+            row["fragments"][summary["name"]] = summary["wall_ms"]
+        at.session_state["messages"] = messages
+    rows.append(row)
+print(json.dumps({"exception": [str(e.value) for e in at.exception], "runs": rows}))
+"""
+
+
+def measure_reruns(script: str, turns: int = 200, repeat: int = 5) -> Dict[str, Any]:
+    """
+    turns 往復ぶんの会話を持たせた状態で、script のページ全体の rerun と、
+    フラグメント単独の rerun（送信直後のように最新の 1 往復が増えた状態）の時間を測る。
+    フラグメントは fragment_profile で包んだものだけが対象（名前ごとに最小値を返す）。
+    LLM の呼び出しそのものは含まない（描画側の時間だけを比べる）。
+    """
+    path = os.path.abspath(script)
+    env = dict(
+        os.environ,
+        LYRA_PROFILE_DIR=os.path.join(PROFILE_DIR, "bench"),
+        LYRA_OPENING_POOL_SIZE="0",
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", _RERUN_PROBE, path, str(turns), str(repeat)],
+        cwd=os.path.dirname(path),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} の rerun 計測に失敗しました:\n{proc.stderr}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    runs = result.pop("runs")
+    result["script"] = script
+    result["full_ms"] = min(r["full_ms"] for r in runs)
+    result["fragments"] = {
+        name: min(r["fragments"][name] for r in runs if name in r["fragments"])
+        for name in sorted({n for r in runs for n in r["fragments"]})
+    }
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Lyra 起動時間・rerun 時間の計測")
+    parser.add_argument("scripts", nargs="+", help="計測するページ（app.py など）")
+    parser.add_argument("--budget-ms", type=int, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数（最小値で判定）")
+    parser.add_argument(
+        "--reruns", type=int, metavar="TURNS",
+        help="起動時間の代わりに、TURNS 往復の会話でページ全体とフラグメント単独の rerun 時間を比べる",
+    )
+    args = parser.parse_args(argv)
+
+    if args.reruns:
+        for script in args.scripts:
+            r = measure_reruns(script, args.reruns, max(1, args.repeat))
+            fragments = " / ".join(
+                f"フラグメント単独 {name} {ms} ms（{ms / r['full_ms']:.1%}）"
+                for name, ms in r["fragments"].items()
+            ) if r["full_ms"] else ""
+            print(
+                f"{script} ({args.reruns} 往復): ページ全体 {r['full_ms']} ms / "
+                + (fragments or "フラグメント単独の計測なし")
+                + (f"  例外: {r['exception']}" if r["exception"] else "")
+            )
+        return 0
+
+    failed = False
+    for script in args.scripts:
+        runs = [measure_startup(script) for _ in range(max(1, args.repeat))]
+        best = min(runs, key=lambda r: r["total_ms"])
+        over = best["total_ms"] > args.budget_ms
+        problems = []
+        if over:
+            problems.append(f"予算 {args.budget_ms} ms 超過")
+        if best["loaded"]:
+            problems.append(f"初回描画前に読み込み: {', '.join(best['loaded'])}")
+        if best["exception"]:
+            problems.append(f"例外: {best['exception']}")
+        failed = failed or bool(problems)
+        print(
+            f"{script}: {best['total_ms']} ms "
+            f"(streamlit {best['streamlit_import_ms']} ms + 初回描画 {best['first_render_ms']} ms)"
+            + (f"  NG: {' / '.join(problems)}" if problems else "  OK")
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
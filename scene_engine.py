@@ -0,0 +1,151 @@
+# scene_engine.py — 複数ペルソナが同じターンに応答するシーンモード
+
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancelToken
+from conversation_engine import LLMConversation
+from debug_buffer import PromptRingBuffer
+from llm_cassette import CassetteMiss
+from output_guard import rules_for_persona
+from personas import get_persona
+
+
+@dataclass
+class SceneMember:
+    char_id: str
+    name: str
+    conversation: LLMConversation
+
+
+class SceneConversation:
+    """
+    1 回のプレイヤー発言に対して、複数ペルソナの LLMConversation を
+    並列に走らせ（fan-out）、結果をメンバー順に揃えて返す（fan-in）。
+    所要時間は各ペルソナの合計ではなく、いちばん遅いペルソナで決まる。
+    """
+
+    def __init__(
+        self,
+        char_ids: List[str],
+        temperature: float = 0.7,
+        max_tokens: int = 800,
+        budgets: Optional[Dict[str, int]] = None,
+    ) -> None:
+        """
+        budgets（char_id -> max_tokens）を省略すると、各ペルソナの max_tokens、
+        それもなければ共通の max_tokens を使う。
+        どの予算も共通の max_tokens（スライダーなど利用者の上限）を超えない。
+        """
+        budgets = budgets or {}
+        self.members: List[SceneMember] = []
+        for char_id in char_ids:
+            persona = get_persona(char_id)
+            self.members.append(
+                SceneMember(
+                    char_id=char_id,
+                    name=persona.name,
+                    conversation=LLMConversation(
+                        system_prompt=persona.system_prompt,
+                        temperature=temperature,
+                        # ペルソナごとのトークン予算（なければ共通の上限。上限は超えない）
+                        max_tokens=min(
+                            budgets.get(char_id)
+                            or getattr(persona, "max_tokens", 0)
+                            or max_tokens,
+                            max_tokens,
+                        ),
+                        style_hint=persona.style_hint,
+                        output_rules=rules_for_persona(persona),
+                        persona_key=persona.char_id,
+                    ),
+                )
+            )
+
+    def generate_replies(
+        self,
+        history: List[Dict[str, str]],
+        prompt_buffer: Optional[PromptRingBuffer] = None,
+        on_delta: Optional[Callable[[int, str], None]] = None,
+        session_id: Optional[str] = None,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> List[Tuple[SceneMember, str, Dict[str, Any]]]:
+        """
+        全メンバーの応答を並列に生成し、メンバー順で返す。
+
+        on_delta(i, text) は呼び出し元のスレッドからだけ呼ぶ（Streamlit の描画用）。
+        表示順を固定するため、i 番目が書き終わるまで i+1 番目以降は溜めておき、
+        順番が来たら溜まった分から続きを流す。
+        cancel_token は全メンバーで共有し、取り消すと全員の生成を打ち切る。
+        """
+        n = len(self.members)
+        if n == 0:
+            return []
+
+        events: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+        latest = [""] * n
+        emitted = [""] * n
+        done = [False] * n
+        results: List[Tuple[str, Dict[str, Any]]] = [("", {})] * n
+        cursor = 0
+
+        pool = ThreadPoolExecutor(max_workers=n, thread_name_prefix="lyra-scene")
+        try:
+            for i, member in enumerate(self.members):
+                pool.submit(
+                    self._run, i, member, history, prompt_buffer, session_id, cancel_token, events
+                )
+
+            while not all(done):
+                i, kind, payload = events.get()
+                if kind == "delta":
+                    latest[i] = payload
+                elif isinstance(payload, CassetteMiss):
+                    raise payload
+                else:
+                    done[i] = True
+                    results[i] = payload
+                    latest[i] = payload[0]
+
+                # 現在の番のメンバーから順に、溜まっている分を流す
+                while cursor < n:
+                    if on_delta is not None and latest[cursor] != emitted[cursor]:
+                        emitted[cursor] = latest[cursor]
+                        on_delta(cursor, latest[cursor])
+                    if not done[cursor]:
+                        break
+                    cursor += 1
+        finally:
+            pool.shutdown(wait=False)
+
+        return [(m, text, meta) for m, (text, meta) in zip(self.members, results)]
+
+    @staticmethod
+    def _run(
+        i: int,
+        member: SceneMember,
+        history: List[Dict[str, str]],
+        prompt_buffer: Optional[PromptRingBuffer],
+        session_id: Optional[str],
+        cancel_token: Optional[CancelToken],
+        events: "queue.Queue[Tuple[int, str, Any]]",
+    ) -> None:
+        result: Any = ("", {"route": "error"})
+        try:
+            result = member.conversation.generate_reply(
+                history,
+                prompt_buffer=prompt_buffer,
+                on_delta=lambda text: events.put((i, "delta", text)),
+                session_id=session_id,
+                cancel_token=cancel_token,
+            )
+        except CassetteMiss as e:
+            # 呼び出し元スレッドで投げ直す
+            result = e
+        except Exception as e:
+            result = ("", {"route": "error", "exception": str(e)})
+        finally:
+            # 例外でも必ず done を送り、fan-in 側が待ち続けないようにする
+            events.put((i, "done", result))
@@ -0,0 +1,338 @@
+# session_manager.py — セッションのメモリ量と最終操作時刻の管理、アイドルセッションのディスク退避
+#
+# 長時間動かす Streamlit サーバでは、開きっぱなし・放置されたタブの
+# messages / llm_meta などが st.session_state に残り続ける。
+# - 各 rerun の先頭で touch() し、セッションごとの概算メモリ量（退避で外れるキーすべて）と
+#   最終操作時刻を記録
+# - IDLE_SEC 以上操作のないセッションは、会話を gzip の JSON スナップショットに
+#   書き出して session_state から外す（system 本文は blob_store の参照にする）
+# - 常駐分の合計が MEM_CAP_MB を超えたら、最後に触られたのが古い順（LRU）に退避
+# - 退避済みセッションは、次に touch() されたときにスナップショットから戻す
+# - スクリプト実行中（rerun・フラグメント・生成中）のセッションは退避しない
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import profiler
+from blob_store import export_log, import_log
+from cancellation import is_turn_running
+from debug_buffer import PROMPT_BUFFER_KEY
+from log_search import SESSION_INDEX_KEY
+from lyra_core import get_session_id
+
+
+SPILL_DIR = os.getenv("LYRA_SPILL_DIR", "sessions")
+IDLE_SEC = float(os.getenv("LYRA_SESSION_IDLE_SEC", "900"))
+MEM_CAP_MB = float(os.getenv("LYRA_SESSION_MEM_MB", "256"))
+SPILL_TTL_SEC = float(os.getenv("LYRA_SPILL_TTL_SEC", str(7 * 24 * 3600)))  # 孤児スナップショットの保持期間
+SWEEP_INTERVAL_SEC = 10.0
+SNAPSHOT_FORMAT = "lyra-session/1"
+
+# 退避中であることを示す session_state のキー（値は退避した時刻）
+SPILLED_KEY = "_spilled_at"
+
+# スナップショットに書き出して戻すキー / 退避時に捨てるだけのキー（デバッグ用で作り直せる）
+SPILL_KEYS = ("messages", "llm_meta", "_last_call_meta")
+DROP_KEYS = (
+    PROMPT_BUFFER_KEY,
+    profiler.RESULT_KEY,
+    profiler.TURN_RESULT_KEY,
+    "_upload_parsed",   # app.py の読込プレビュー用キャッシュ
+    SESSION_INDEX_KEY,  # 検索パネルのセッション専用インデックス（次に検索したときに作り直す）
+)
+
+
+def approx_size(obj: Any, seen: Optional[Set[int]] = None) -> int:
+    """
+    dict / list / str の入れ子（検索インデックスなどのオブジェクトは属性）をたどった概算バイト数。
+    同じオブジェクトは 1 回だけ数える（seen に入っているものは数えない）。
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_size(k, seen) + approx_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for v in obj:
+            size += approx_size(v, seen)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += approx_size(vars(obj), seen)
+    return size
+
+
+def _state_size(state: Any) -> int:
+    """退避で外れるキー（SPILL_KEYS と DROP_KEYS）の概算バイト数。"""
+    seen: Set[int] = set()
+    messages = state["messages"] if "messages" in state else None
+    if isinstance(messages, list):
+        # system 本文は blob_store で全セッション共有なので数えない（バッファ側の参照も同様）
+        for m in messages:
+            if isinstance(m, dict) and m.get("role") == "system":
+                seen.update((id(m), id(m.get("content"))))
+    size = 0
+    for key in SPILL_KEYS + DROP_KEYS:
+        if key in state:
+            size += approx_size(state[key], seen)
+    return size
+
+
+def _state_handles(state: Any) -> Tuple[Any, Any]:
+    """
+    (セッションの実体, この実行のあいだだけ生きている目印) を返す。
+    st.session_state（現在のスクリプトに紐づくプロキシ）なら、実体は Streamlit の
+    SessionState（セッションが閉じるまで同じもの）、目印はスクリプト実行ごとに作られ、
+    実行が終わると捨てられる SafeSessionState。dict などはそのもの、目印なし。
+    """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        from streamlit.runtime.state import SessionStateProxy
+    except ImportError:
+        return state, None
+    if isinstance(state, SessionStateProxy):
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            run = ctx.session_state
+            return getattr(run, "_state", run), run
+    return state, None
+
+
+def _dead() -> None:
+    return None
+
+
+@dataclass
+class SessionEntry:
+    session_id: str
+    ref: Callable[[], Any]          # session_state の実体（消えていれば None を返す）
+    last_active: float
+    run: Callable[[], Any] = _dead  # 最後の実行の目印（実行が終わっていれば None を返す）
+    resident_bytes: int = 0
+    spilled_path: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        """スクリプト（rerun・フラグメント）か LLM の生成が走っているか。"""
+        return self.run() is not None or is_turn_running(self.session_id)
+
+
+class SessionManager:
+    def __init__(
+        self,
+        spill_dir: str = SPILL_DIR,
+        idle_sec: float = IDLE_SEC,
+        mem_cap_bytes: int = int(MEM_CAP_MB * 1024 * 1024),
+    ) -> None:
+        self.spill_dir = spill_dir
+        self.idle_sec = float(idle_sec)
+        self.mem_cap_bytes = int(mem_cap_bytes)
+        self._lock = threading.RLock()
+        self._entries: Dict[str, SessionEntry] = {}
+        self._swept_at = 0.0
+        self._counts = {"spilled": 0, "restored": 0, "restore_failed": 0}
+
+    # ===== 公開 API =====
+    def touch(self, state: Any) -> str:
+        """
+        rerun の先頭で呼ぶ。退避済みなら会話を戻し、最終操作時刻とメモリ量を更新する。
+        ついでに（間引きつつ）ほかのセッションの退避判定も行う。
+        """
+        session_id = get_session_id(state)
+        now = time.monotonic()
+        handle, run = _state_handles(state)
+        with profiler.span("session_touch"), self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.ref() is not handle:
+                entry = SessionEntry(session_id, self._ref(handle), now)
+                self._entries[session_id] = entry
+            entry.run = self._ref(run) if run is not None else _dead
+            if SPILLED_KEY in state:
+                self._restore(entry, state)
+            entry.last_active = now
+            entry.resident_bytes = _state_size(state)
+
+            if now - self._swept_at >= SWEEP_INTERVAL_SEC:
+                self._swept_at = now
+                self.sweep(now, exclude=session_id)
+        return session_id
+
+    def spill(self, session_id: str) -> bool:
+        """
+        セッションの会話をスナップショットに書き出して外す。退避したら True。
+        スクリプト実行中のセッションは、そのスクリプトが読んでいるキーを
+        別スレッドから消すことになるので退避しない。
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            state = entry.ref() if entry else None
+            if state is None or entry.spilled_path or entry.running:
+                return False
+
+            snapshot: Dict[str, Any] = {"format": SNAPSHOT_FORMAT, "session_id": session_id}
+            for key in SPILL_KEYS:
+                if key in state:
+                    value = state[key]
+                    snapshot[key] = export_log(value) if key == "messages" else value
+
+            path = self._path(session_id)
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                tmp = f"{path}.tmp"
+                with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False, default=str)
+                os.replace(tmp, path)
+            except OSError:
+                # 書けなければメモリに残したままにする
+                return False
+
+            for key in SPILL_KEYS + DROP_KEYS:
+                if key in state:
+                    del state[key]
+            state[SPILLED_KEY] = time.time()
+            entry.spilled_path = path
+            entry.resident_bytes = 0
+            self._counts["spilled"] += 1
+            return True
+
+    def sweep(self, now: Optional[float] = None, exclude: Optional[str] = None) -> List[str]:
+        """
+        消えたセッションの後始末、アイドルセッションの退避、メモリ上限による
+        LRU 退避を行い、退避したセッション ID を返す。
+        """
+        now = time.monotonic() if now is None else now
+        spilled: List[str] = []
+        with self._lock:
+            for session_id, entry in list(self._entries.items()):
+                if entry.ref() is None:
+                    # Streamlit 側でセッションが破棄された。戻す先がないのでスナップショットも消す
+                    self._discard(entry)
+
+            candidates = sorted(
+                (e for e in self._entries.values()
+                 if not e.spilled_path and e.session_id != exclude),
+                key=lambda e: e.last_active,
+            )
+            resident = sum(e.resident_bytes for e in self._entries.values())
+            for entry in candidates:
+                idle = now - entry.last_active >= self.idle_sec
+                if not idle and resident <= self.mem_cap_bytes:
+                    break
+                size = entry.resident_bytes
+                if self.spill(entry.session_id):
+                    spilled.append(entry.session_id)
+                    resident -= size
+
+        self._remove_orphans()
+        return spilled
+
+    def messages(self, session_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        セッションの会話のコピー（退避中ならスナップショットから読むだけで、戻しはしない）。
+        ダウンロードのように、スクリプトの外から会話を読むときに使う。
+        知らないセッション・読めないスナップショットなら None。
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            state = entry.ref() if entry else None
+            if state is None:
+                return None
+            if not entry.spilled_path:
+                return list(state["messages"]) if "messages" in state else None
+            path = entry.spilled_path
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            return import_log(snapshot.get("messages") or [])
+        except (OSError, ValueError):
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = list(self._entries.values())
+            return {
+                "sessions": len(entries),
+                "resident": sum(1 for e in entries if not e.spilled_path),
+                "resident_kb": sum(e.resident_bytes for e in entries) // 1024,
+                **self._counts,
+            }
+
+    # ===== 内部 =====
+    @staticmethod
+    def _ref(handle: Any) -> Callable[[], Any]:
+        try:
+            return weakref.ref(handle)
+        except TypeError:
+            # dict などは弱参照できないので、そのまま持つ
+            return lambda: handle
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{session_id}.json.gz")
+
+    def _restore(self, entry: SessionEntry, state: Any) -> None:
+        path = entry.spilled_path or self._path(entry.session_id)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            for key in SPILL_KEYS:
+                if key in snapshot:
+                    value = snapshot[key]
+                    state[key] = import_log(value) if key == "messages" else value
+            self._counts["restored"] += 1
+        except (OSError, ValueError):
+            # 戻せなければ新しい会話として始める（画面側の初期化に任せる）
+            self._counts["restore_failed"] += 1
+        del state[SPILLED_KEY]
+        entry.spilled_path = None
+        self._unlink(path)
+
+    def _discard(self, entry: SessionEntry) -> None:
+        self._entries.pop(entry.session_id, None)
+        if entry.spilled_path:
+            self._unlink(entry.spilled_path)
+
+    def _remove_orphans(self) -> None:
+        """再起動前のプロセスが残したスナップショットなど、古いものを消す。"""
+        try:
+            names = os.listdir(self.spill_dir)
+        except OSError:
+            return
+        cutoff = time.time() - SPILL_TTL_SEC
+        for name in names:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_manager: Optional[SessionManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    """プロセス共有のセッションマネージャ。"""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = SessionManager()
+    return _manager
@@ -0,0 +1,34 @@
+# test_blob_store.py — 持ち出し用ログの同梱と、引けない参照の補い
+import pytest
+
+from blob_store import BlobStore, export_log, import_log
+
+PROMPT = "あなたはフローリア。" * 50
+
+
+def log():
+    return [
+        {"role": "system", "content": PROMPT},
+        {"role": "user", "content": "こんにちは"},
+        {"role": "assistant", "content": "いらっしゃい"},
+    ]
+
+
+def test_embedded_export_loads_into_another_store(tmp_path):
+    here = BlobStore(root=str(tmp_path / "here"))
+    here.register(PROMPT)
+    data = export_log(log(), here, embed=True)
+    assert import_log(data, BlobStore(root=None)) == log()
+
+
+def test_unresolved_system_ref_falls_back_to_current_prompt(tmp_path):
+    here = BlobStore(root=str(tmp_path / "here"))
+    here.register(PROMPT)
+    data = export_log(log(), here)
+    assert data["blobs"] == {}
+
+    elsewhere = BlobStore(root=str(tmp_path / "elsewhere"))
+    with pytest.raises(ValueError):
+        import_log(data, elsewhere)
+    restored = import_log(data, elsewhere, fallback_system="新しい人格")
+    assert restored[0]["content"] == "新しい人格" and restored[1:] == log()[1:]
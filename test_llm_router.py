@@ -0,0 +1,55 @@
+# test_llm_router.py — 録画するストリームとしないストリーム
+from types import SimpleNamespace
+
+import llm_router
+from cancellation import CancelToken
+from llm_cassette import use_cassette
+
+MESSAGES = [{"role": "user", "content": "こんにちは"}]
+
+
+class FakeResponse:
+    def __init__(self, texts):
+        self.texts = texts
+
+    def __iter__(self):
+        for text in self.texts:
+            delta = SimpleNamespace(content=text)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(finish_reason=None, delta=delta)])
+
+    def close(self):
+        pass
+
+
+def fake_client(texts):
+    create = lambda **kwargs: FakeResponse(texts)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def start(monkeypatch, texts, token=None):
+    monkeypatch.setattr(llm_router, "_client", lambda: fake_client(texts))
+    monkeypatch.setattr(llm_router, "_acquire", lambda *args: None)
+    return llm_router.ChatStream(MESSAGES, 0.7, 100, cancel_token=token)
+
+
+def test_closed_stream_is_recorded_up_to_the_cut(tmp_path, monkeypatch):
+    # 出力ガードの打ち切り（close()）は、再生でも同じ位置で打ち切られるので録る
+    with use_cassette(str(tmp_path / "c.jsonl"), mode="record") as cassette:
+        stream = start(monkeypatch, ["一", "二", "三"])
+        for text in stream:
+            if text == "二":
+                stream.close()
+                break
+    (entry,) = [e for entries in cassette._entries.values() for e in entries]
+    assert [t for _, t in entry["chunks"]] == ["一", "二"]
+
+
+def test_cancelled_stream_is_not_recorded(tmp_path, monkeypatch):
+    token = CancelToken()
+    with use_cassette(str(tmp_path / "c.jsonl"), mode="record") as cassette:
+        stream = start(monkeypatch, ["一", "二", "三"], token)
+        for text in stream:
+            if text == "二":
+                token.cancel("reset")
+    assert stream.meta["cancelled"] == "reset"
+    assert cassette._entries == {}
@@ -0,0 +1,38 @@
+# test_log_search.py — 1 文字検索・差分同期・詰め直し
+from log_search import LogSearchIndex
+
+
+def msgs(*texts):
+    return [{"role": "user", "content": t} for t in texts]
+
+
+def test_single_cjk_char_matches_inside_bigrams():
+    index = LogSearchIndex()
+    index.add_messages("s", msgs("湖のほとりで会おう", "山に行く", "湖"))
+    assert sorted(h.index for h in index.search("湖")) == [0, 2]
+    assert [h.index for h in index.search("山")] == [1]
+
+
+def test_sync_session_adds_tail_and_reindexes_replaced_list():
+    index = LogSearchIndex()
+    log = msgs("りんごの話")
+    index.sync_session("s", log)
+    log.append({"role": "assistant", "content": "みかんの話"})
+    assert index.sync_session("s", log) == 1
+
+    # 丸めなどで別のリストに差し替わったら入れ直す（メッセージ番号も振り直し）
+    trimmed = log[1:] + msgs("ぶどうの話")
+    index.sync_session("s", trimmed)
+    assert [h.index for h in index.search("みかん")] == [0]
+    assert index.search("りんご") == []
+
+
+def test_removed_sessions_are_compacted():
+    index = LogSearchIndex()
+    index.add_messages("keep", msgs("残す話"))
+    for i in range(10):
+        index.index_session("live", msgs(f"{i} 回目の話", "ペンギン"))
+    assert index.stats()["messages"] == 3
+    # 入れ直しのたびに本文が溜まっていかない（削除済みは半分未満に保たれる）
+    assert len(index._docs) < 2 * 3
+    assert [h.session_id for h in index.search("残す")] == ["keep"]
@@ -0,0 +1,43 @@
+# test_lyra_core.py — 取り消されたターンは返事のない発言を残さない
+from lyra_core import LyraCore
+
+
+class StubConversation:
+    def __init__(self, reply, meta):
+        self.reply, self.meta = reply, meta
+
+    def generate_reply(self, messages, **kwargs):
+        return self.reply, self.meta
+
+
+def new_state():
+    return {"messages": [{"role": "system", "content": "system"}]}
+
+
+def test_cancelled_turn_removes_user_message():
+    state = new_state()
+    core = LyraCore(StubConversation("", {"route": "gpt", "cancelled": "superseded"}))
+    messages, meta = core.proceed_turn("こんにちは", state)
+    assert meta["cancelled"] == "superseded"
+    assert messages == [{"role": "system", "content": "system"}]
+
+
+def test_cancelled_turn_leaves_replaced_conversation_alone():
+    # リセットで会話が差し替わった後に取り消しが届いても、新しい会話には触れない
+    state = new_state()
+
+    class Resetting(StubConversation):
+        def generate_reply(self, messages, **kwargs):
+            state["messages"] = [{"role": "user", "content": "こんにちは"}]
+            return super().generate_reply(messages, **kwargs)
+
+    core = LyraCore(Resetting("", {"route": "gpt", "cancelled": "reset"}))
+    core.proceed_turn("こんにちは", state)
+    assert state["messages"] == [{"role": "user", "content": "こんにちは"}]
+
+
+def test_answered_turn_keeps_both_messages():
+    state = new_state()
+    core = LyraCore(StubConversation("いらっしゃい", {"route": "gpt"}))
+    messages, _ = core.proceed_turn("こんにちは", state)
+    assert [m["role"] for m in messages] == ["system", "user", "assistant"]
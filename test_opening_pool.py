@@ -0,0 +1,67 @@
+# test_opening_pool.py — 補充に失敗したら、待ち時間が明けるまで試し直さない
+import opening_pool
+from opening_pool import OpeningPool
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class StubConversation:
+    persona_key = "stub"
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def build_messages(self, messages):
+        return [{"role": "system", "content": "stub"}]
+
+    def generate_reply(self, messages, **kwargs):
+        self.calls += 1
+        self.kwargs = kwargs
+        if not self.replies:
+            return "", {"route": "error", "gpt_error": "429"}
+        return self.replies.pop(0), {"route": "gpt"}
+
+
+def new_pool(size=2):
+    pool = OpeningPool(size=size)
+    pool._executor = InlineExecutor()
+    return pool
+
+
+def test_failed_fill_backs_off_until_retry_time(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(opening_pool.time, "monotonic", lambda: clock[0])
+    pool, conv = new_pool(), StubConversation([])
+
+    pool.warm(conv)
+    for _ in range(5):   # rerun のたびに warm() されても API は叩かない
+        pool.warm(conv)
+    assert conv.calls == 1 and pool.failures("stub") == 1
+
+    clock[0] += opening_pool.RETRY_BASE_SEC
+    pool.warm(conv)
+    assert conv.calls == 2 and pool.failures("stub") == 2
+
+    # 2 回目の失敗の後は倍の時間を待つ
+    clock[0] += opening_pool.RETRY_BASE_SEC
+    pool.warm(conv)
+    assert conv.calls == 2
+
+
+def test_successful_fill_resets_backoff(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(opening_pool.time, "monotonic", lambda: clock[0])
+    pool, conv = new_pool(), StubConversation([])
+    pool.warm(conv)
+
+    conv.replies = ["こんにちは", "いらっしゃい"]
+    clock[0] += opening_pool.RETRY_BASE_SEC
+    pool.warm(conv)
+    assert pool.stats() == {"stub": 2} and pool.failures("stub") == 0
+    assert pool.take(conv)[0] == "こんにちは"
+    # 作り置きの挨拶は応答長の推定に混ぜない
+    assert conv.kwargs["learn"] is False
@@ -0,0 +1,37 @@
+# test_output_guard.py — OutputGuard の行単位の検査
+import pytest
+
+from output_guard import GuardViolation, OutputGuard, OutputRules
+
+RULES = OutputRules(
+    line_prefixes=("*", "・"),
+    patterns=(r"[A-Za-z][A-Za-z_\-]{2,}\s*[:：]",),
+)
+
+
+def feed_all(guard: OutputGuard, deltas) -> str:
+    text = "".join(guard.feed(d) for d in deltas)
+    return text + guard.finish()
+
+
+@pytest.mark.parametrize("deltas", [
+    ["onstage", ":\n続き"],            # 改行と同じ差分で行が閉じる
+    ["onstage: 花\nこんにちは"],        # 違反行のあとに次の行が続く
+    ["前置き\nonstage: 花\n", "続き"],  # 途中の行
+    ["onstage: 花"],                    # 改行のない最後の行
+])
+def test_violation_in_completed_line_is_detected(deltas):
+    with pytest.raises(GuardViolation):
+        feed_all(OutputGuard(RULES), deltas)
+
+
+def test_non_strict_records_violation_once():
+    guard = OutputGuard(RULES, strict=False)
+    feed_all(guard, ["onstage: 花\nonscreen: 湖\n"])
+    assert guard.violations == [RULES.patterns[0]]
+
+
+def test_line_prefix_is_repaired_across_deltas():
+    guard = OutputGuard(RULES)
+    assert feed_all(guard, ["＊", "\n", "  ", "* 湖のほとり\n・ 花"]) == "＊\n湖のほとり\n花"
+    assert guard.repairs == 2
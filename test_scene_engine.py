@@ -0,0 +1,68 @@
+# test_scene_engine.py — 2 人のシーンで、ペルソナごとの予算と表示順を確かめる
+import threading
+import time
+from dataclasses import replace
+
+import pytest
+
+import conversation_engine
+import scene_engine
+from personas.persona_floria_ja import FLORIA_JA
+
+PERSONAS = {
+    "a": replace(FLORIA_JA, char_id="a", name="エー", system_prompt="persona-a", max_tokens=300),
+    "b": replace(FLORIA_JA, char_id="b", name="ビー", system_prompt="persona-b"),
+}
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    monkeypatch.setenv("LYRA_ADAPTIVE_MAX_TOKENS", "0")
+    monkeypatch.setattr(scene_engine, "get_persona", PERSONAS.__getitem__)
+    calls = {}
+    b_done = threading.Event()
+
+    def generate_guarded(messages, temperature, max_tokens, rules, on_delta=None, **kwargs):
+        who = "a" if messages[0]["content"].startswith("persona-a") else "b"
+        calls[who] = max_tokens
+        if who == "a":
+            # b が先に書き終わっても、表示は a → b の順になることを見る
+            b_done.wait(1)
+            time.sleep(0.01)
+        text = ""
+        for part in (f"{who}1", f"{who}2"):
+            text += part
+            if on_delta is not None:
+                on_delta(text)
+        if who == "b":
+            b_done.set()
+        return text, {"route": "gpt"}
+
+    monkeypatch.setattr(conversation_engine, "generate_guarded", generate_guarded)
+    return calls
+
+
+def test_scene_uses_persona_budgets_and_member_order(fake_llm):
+    scene = scene_engine.SceneConversation(["a", "b"], max_tokens=800)
+    shown = []
+    replies = scene.generate_replies(
+        [{"role": "user", "content": "こんにちは"}],
+        on_delta=lambda i, text: shown.append((i, text)),
+    )
+
+    assert fake_llm == {"a": 300, "b": 800}
+    assert [(m.char_id, text) for m, text, _meta in replies] == [("a", "a1a2"), ("b", "b1b2")]
+    order = [i for i, _text in shown]
+    assert order == sorted(order) and shown[-1] == (1, "b1b2")
+
+
+def test_explicit_budgets_override_persona(fake_llm):
+    scene = scene_engine.SceneConversation(["a", "b"], max_tokens=800, budgets={"a": 100, "b": 200})
+    scene.generate_replies([{"role": "user", "content": "やあ"}])
+    assert fake_llm == {"a": 100, "b": 200}
+
+
+def test_budgets_stay_within_callers_ceiling(fake_llm):
+    scene = scene_engine.SceneConversation(["a", "b"], max_tokens=250, budgets={"b": 1000})
+    scene.generate_replies([{"role": "user", "content": "やあ"}])
+    assert fake_llm == {"a": 250, "b": 250}
@@ -0,0 +1,57 @@
+# test_session_manager.py — アイドル退避と、実行中セッションの保護
+from session_manager import SPILLED_KEY, SessionManager
+
+
+def new_state(text: str) -> dict:
+    return {"messages": [{"role": "user", "content": text}]}
+
+
+def test_idle_session_is_spilled_and_restored(tmp_path):
+    manager = SessionManager(spill_dir=str(tmp_path), idle_sec=0, mem_cap_bytes=1 << 30)
+    idle, other = new_state("覚えていてね"), new_state("こんにちは")
+    idle_id = manager.touch(idle)
+    manager.touch(other)
+
+    assert manager.sweep(exclude=manager.touch(other)) == [idle_id]
+    assert "messages" not in idle and SPILLED_KEY in idle
+
+    manager.touch(idle)
+    assert idle["messages"] == [{"role": "user", "content": "覚えていてね"}]
+    assert manager.stats()["restored"] == 1 and not list(tmp_path.iterdir())
+
+
+def test_running_session_is_not_spilled_over_memory_cap(tmp_path):
+    manager = SessionManager(spill_dir=str(tmp_path), idle_sec=3600, mem_cap_bytes=0)
+    busy, idle = new_state("生成中"), new_state("待機中")
+    busy_id, idle_id = manager.touch(busy), manager.touch(idle)
+
+    # busy はスクリプトがまだ走っている（実行ごとの目印が生きている）
+    marker = object()
+    manager._entries[busy_id].run = lambda: marker
+
+    assert manager.sweep() == [idle_id]
+    assert busy["messages"][0]["content"] == "生成中"
+
+
+def test_messages_reads_spilled_snapshot_without_restoring(tmp_path):
+    manager = SessionManager(spill_dir=str(tmp_path), idle_sec=0, mem_cap_bytes=1 << 30)
+    state = new_state("持ち帰りたい会話")
+    session_id = manager.touch(state)
+    assert manager.messages(session_id) == state["messages"]
+
+    assert manager.spill(session_id)
+    assert manager.messages(session_id) == [{"role": "user", "content": "持ち帰りたい会話"}]
+    assert "messages" not in state and SPILLED_KEY in state
+
+
+def test_dropped_keys_count_toward_resident_size(tmp_path):
+    from log_search import SESSION_INDEX_KEY, LogSearchIndex
+    from session_manager import _state_size
+
+    state = new_state("短い")
+    small = _state_size(state)
+    state["_upload_parsed"] = ("file", [{"role": "user", "content": "長い" * 5000}], None)
+    index = LogSearchIndex()
+    index.add_messages("s", [{"role": "user", "content": "湖のほとり" * 2000}])
+    state[SESSION_INDEX_KEY] = index
+    assert _state_size(state) > small + 2 * 10000 + 2 * 10000
@@ -0,0 +1,20 @@
+# test_startup.py — 起動時間の予算と、初回描画前に読み込まないモジュール
+import os
+
+import pytest
+
+pytest.importorskip("streamlit.testing.v1")
+
+import profiler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPEAT = 3   # 別プロセスでの計測は揺れるので、CLI と同じく最小値で判定する
+
+
+@pytest.mark.parametrize("script", ["app.py", "lyra_engine.py"])
+def test_first_paint_within_budget(script):
+    runs = [profiler.measure_startup(os.path.join(HERE, script)) for _ in range(REPEAT)]
+    best = min(runs, key=lambda r: r["total_ms"])
+    assert not best["exception"]
+    assert best["loaded"] == []
+    assert best["total_ms"] <= profiler.STARTUP_BUDGET_MS, best
@@ -0,0 +1,34 @@
+# test_token_predictor.py — 応答長からの max_tokens 推定
+from llm_cassette import use_cassette
+from token_predictor import TokenPredictor
+
+
+def observe(predictor: TokenPredictor, tokens: int, n: int = 5, finish: str = "stop") -> None:
+    for _ in range(n):
+        predictor.observe("p", "s", {"usage_main": {"completion_tokens": tokens}, "finish_reason": finish})
+
+
+def test_prediction_follows_observed_lengths():
+    predictor = TokenPredictor()
+    assert predictor.predict("p", "s", 800)[0] == 800
+    observe(predictor, 100)
+    limit, info = predictor.predict("p", "s", 800)
+    assert limit == 125 and info["source"] == "session"
+
+
+def test_truncated_reply_returns_to_ceiling_once():
+    predictor = TokenPredictor()
+    observe(predictor, 100)
+    observe(predictor, 125, n=1, finish="length")
+    limit, info = predictor.predict("p", "s", 800)
+    assert (limit, info["source"]) == (800, "after_truncation")
+    assert predictor.predict("p", "s", 800)[1]["source"] == "session"
+
+
+def test_cassette_uses_fixed_ceiling(tmp_path):
+    # 学習済みの履歴があっても、カセットの照合キー（max_tokens）を変えない
+    predictor = TokenPredictor()
+    observe(predictor, 100)
+    with use_cassette(str(tmp_path / "c.jsonl")):
+        limit, info = predictor.predict("p", "s", 800)
+    assert (limit, info["source"]) == (800, "cassette")
@@ -0,0 +1,144 @@
+# token_predictor.py — 実際の応答長から、ターンごとの max_tokens を決める
+#
+# 固定の max_tokens（スライダーの 800 など）は、大きすぎればスケジューラの
+# トークン予算を余計に予約し、小さすぎれば応答が途中で切れる。
+# ペルソナ単位・セッション単位に直近の completion_tokens を覚えておき、
+# その分位点（既定 90%）に余裕を掛けた値を、ユーザー指定の上限の範囲で使う。
+# - finish_reason == "length"（上限で切れた）は、本当の長さが分からないので
+#   多めに見積もって記録し、次のターンはそのセッションだけ上限いっぱいに戻す
+# - サンプルが少ないうちは、セッション → ペルソナ → 上限そのまま の順に頼る
+# - カセットの録画・再生中は上限そのもの（max_tokens はカセットの照合キーに入るので、
+#   それまでに学習した履歴で値が変わると、同じリクエストでも再生できなくなる）
+
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+from llm_cassette import get_cassette
+
+
+ADAPTIVE_ENV = "LYRA_ADAPTIVE_MAX_TOKENS"   # "0" で無効（常にユーザー指定の上限）
+WINDOW = int(os.getenv("LYRA_TOKEN_WINDOW", "50"))
+QUANTILE = float(os.getenv("LYRA_TOKEN_QUANTILE", "0.9"))
+HEADROOM = 1.25           # 分位点に掛ける余裕
+MIN_SAMPLES = 5           # これ未満のサンプルでは推定しない
+MIN_TOKENS = 64           # 推定値の下限
+TRUNCATED_GROWTH = 1.5    # 上限で切れた応答は、この倍はあったものとして記録
+MAX_SESSIONS = 2000       # セッション単位の履歴を持つ数（古いものから捨てる）
+
+
+def quantile(samples: "Deque[int]", q: float) -> int:
+    """最近傍順位法の分位点。"""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(q * len(ordered)))
+    return ordered[rank - 1]
+
+
+class TokenPredictor:
+    def __init__(
+        self,
+        window: int = WINDOW,
+        q: float = QUANTILE,
+        headroom: float = HEADROOM,
+        min_samples: int = MIN_SAMPLES,
+    ) -> None:
+        self.window = max(1, int(window))
+        self.q = min(max(float(q), 0.0), 1.0)
+        self.headroom = float(headroom)
+        self.min_samples = max(1, int(min_samples))
+        self._lock = threading.Lock()
+        self._persona: Dict[str, Deque[int]] = {}
+        self._session: "OrderedDict[Tuple[str, str], Deque[int]]" = OrderedDict()
+        self._truncated: Set[Tuple[str, str]] = set()
+
+    def predict(
+        self,
+        persona_key: str,
+        session_id: Optional[str],
+        ceiling: int,
+    ) -> Tuple[int, Dict[str, Any]]:
+        """このターンに使う max_tokens と、meta に載せる推定の内訳を返す。"""
+        ceiling = int(ceiling)
+        info: Dict[str, Any] = {"ceiling": ceiling, "source": "ceiling", "samples": 0}
+        if os.getenv(ADAPTIVE_ENV) == "0" or get_cassette() is not None:
+            info["source"] = "fixed" if os.getenv(ADAPTIVE_ENV) == "0" else "cassette"
+            info["predicted"] = ceiling
+            return ceiling, info
+
+        key = (persona_key, session_id or "")
+        with self._lock:
+            if key in self._truncated:
+                # 前のターンが上限で切れた。今回は上限いっぱいで取り直す
+                self._truncated.discard(key)
+                info["source"] = "after_truncation"
+                samples = None
+            else:
+                samples = self._session.get(key)
+                if samples is not None and len(samples) >= self.min_samples:
+                    info["source"] = "session"
+                else:
+                    samples = self._persona.get(persona_key)
+                    if samples is not None and len(samples) >= self.min_samples:
+                        info["source"] = "persona"
+                    else:
+                        samples = None
+
+            if samples is None:
+                limit = ceiling
+            else:
+                info["samples"] = len(samples)
+                info["quantile_tokens"] = quantile(samples, self.q)
+                limit = math.ceil(info["quantile_tokens"] * self.headroom)
+
+        limit = max(min(limit, ceiling), min(MIN_TOKENS, ceiling))
+        info["predicted"] = limit
+        return limit, info
+
+    def observe(
+        self,
+        persona_key: str,
+        session_id: Optional[str],
+        meta: Dict[str, Any],
+    ) -> None:
+        """生成結果の meta（usage_main / finish_reason）から応答長を記録する。"""
+        usage = meta.get("usage_main") or {}
+        tokens = usage.get("completion_tokens")
+        if meta.get("cancelled") or usage.get("estimated") or not tokens:
+            # 打ち切った応答の長さは、本来の長さとは関係ない
+            return
+
+        key = (persona_key, session_id or "")
+        truncated = meta.get("finish_reason") == "length"
+        if truncated:
+            tokens = math.ceil(tokens * TRUNCATED_GROWTH)
+
+        with self._lock:
+            self._persona.setdefault(persona_key, deque(maxlen=self.window)).append(int(tokens))
+            samples = self._session.get(key)
+            if samples is None:
+                samples = deque(maxlen=self.window)
+                self._session[key] = samples
+                while len(self._session) > MAX_SESSIONS:
+                    old, _ = self._session.popitem(last=False)
+                    self._truncated.discard(old)
+            else:
+                self._session.move_to_end(key)
+            samples.append(int(tokens))
+            if truncated:
+                self._truncated.add(key)
+
+
+_predictor: Optional[TokenPredictor] = None
+_predictor_lock = threading.Lock()
+
+
+def get_token_predictor() -> TokenPredictor:
+    """プロセス共有の推定器。"""
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                _predictor = TokenPredictor()
+    return _predictor